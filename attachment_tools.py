@@ -0,0 +1,237 @@
+## File attachments: read off the event loop, split into token-sized chunks, and indexed,
+# so the prompt gets the few chunks that matter for the question instead of the whole file.
+# Files are stored once by content hash; the chat history only holds small reference messages
+# (see AttachmentStore.reference), which ContextBuilder.abuild expands when they make it into the context.
+import os
+import json
+import time
+import codecs
+import asyncio
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from langchain_core.messages import HumanMessage
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from tools import count_tokens
+from vector_tools import FlatIndex
+
+
+async def read_text_blocks(path, block_bytes=256 * 1024, encoding="utf-8"):
+    """Yield a file's text block by block, with the reads done in a worker thread.
+    Multi-byte characters split across blocks are handled by the incremental decoder."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        while True:
+            block = await asyncio.to_thread(f.read, block_bytes)
+            if not block:
+                break
+            text = decoder.decode(block)
+            if text:
+                yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+    finally:
+        f.close()
+
+def sha256_file(path, block_bytes=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_bytes), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_text_file(element):
+    return element.type == "file" and (element.mime == "text/plain" or not element.mime)
+
+def referenced_files(messages):
+    """The attachment hashes referenced by these messages, oldest first, without repeats."""
+    file_ids = []
+    for message in messages:
+        file_id = message.additional_kwargs.get("attachment")
+        if file_id and file_id not in file_ids:
+            file_ids.append(file_id)
+    return file_ids
+
+
+class AttachmentStore:
+    """Content-addressed store of file attachments: sha256 of the file -> its chunks, token counts and embeddings.
+
+    A file that's already stored (uploaded again, in any session) is recognised by its hash and not read or embedded again.
+    Files are read and split with a token-aware RecursiveCharacterTextSplitter (chunk_tokens per chunk, counted with
+    tools.count_tokens) one block at a time, and each block's chunks are embedded in one batch, so reading and
+    embedding never need the raw file in memory at once. The chunk texts (the whole file's text, split up) are kept
+    in the record, though, for building prompts. Each file gets its own FlatIndex, sized to its chunk count.
+    With store_dir, every file is also saved as <sha256>.json (names, chunks, token counts) and <sha256>.npy (vectors),
+    and loaded back (vectors memory-mapped) the first time it's needed after a restart.
+    Then only the max_files most recently used files stay in memory; the rest are loaded again from store_dir when needed.
+    Without store_dir every file stays in memory, since an evicted one couldn't come back.
+    """
+    def __init__(self, embeddings, model="gpt-4.1", chunk_tokens=500, chunk_overlap=50, block_bytes=256 * 1024, store_dir=None,
+                 max_files=64):
+        self.embeddings = embeddings
+        self.embedding_model = getattr(embeddings, "model", None) # stored vectors are only reused with the same model
+        self.model = model
+        self.block_bytes = block_bytes
+        self.store_dir = store_dir
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_tokens,
+            chunk_overlap=chunk_overlap,
+            length_function=lambda text: count_tokens(text, model),
+        )
+        self.max_files = max_files
+        self.files = OrderedDict() # sha256 -> {"name", "chunks", "token_counts", "tokens", "index"}, least recently used first
+        self.pending = {} # sha256 -> task ingesting it, so simultaneous uploads of one file are only processed once
+        self.reused = 0
+        self.ingested = 0
+
+    def _split(self, text):
+        pieces = self.splitter.split_text(text)
+        return pieces, [count_tokens(piece, self.model) for piece in pieces]
+
+    async def _chunks(self, path):
+        """Yield (chunks, token counts) one block at a time, splitting and counting in a worker thread.
+        The last chunk of a block is held back and re-split with the next block, since it probably stops mid-line."""
+        carry = ""
+        async for block in read_text_blocks(path, self.block_bytes):
+            pieces, tokens = await asyncio.to_thread(self._split, carry + block)
+            carry = pieces.pop() if pieces else ""
+            if pieces:
+                yield pieces, tokens[:len(pieces)]
+        if carry:
+            yield [carry], [count_tokens(carry, self.model)]
+
+    def _paths(self, file_id):
+        return os.path.join(self.store_dir, f"{file_id}.json"), os.path.join(self.store_dir, f"{file_id}.npy")
+
+    def _load(self, file_id):
+        json_path, npy_path = self._paths(file_id)
+        if not (os.path.exists(json_path) and os.path.exists(npy_path)):
+            return None
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("embedding_model") != self.embedding_model:
+            return None
+        index = FlatIndex()
+        index.load_matrix([f"{file_id}:{i}" for i in range(len(data["chunks"]))], np.load(npy_path, mmap_mode="r"))
+        return {"name": data["name"], "chunks": data["chunks"], "token_counts": data["token_counts"],
+                "tokens": sum(data["token_counts"]), "index": index}
+
+    def _save(self, file_id, record):
+        json_path, npy_path = self._paths(file_id)
+        ids = [f"{file_id}:{i}" for i in range(len(record["chunks"]))]
+        with open(npy_path + ".tmp", "wb") as f:
+            np.save(f, record["index"].get_vectors(ids) if ids else np.zeros((0, 0), dtype=np.float32))
+        with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"name": record["name"], "embedding_model": self.embedding_model,
+                       "chunks": record["chunks"], "token_counts": record["token_counts"]}, f, ensure_ascii=False)
+        os.replace(npy_path + ".tmp", npy_path)
+        os.replace(json_path + ".tmp", json_path) # the .json goes last, so a crash never leaves one without its vectors
+
+    def _remember(self, file_id, record):
+        self.files[file_id] = record
+        self.files.move_to_end(file_id)
+        while self.store_dir and len(self.files) > self.max_files:
+            self.files.popitem(last=False) # it's in store_dir, and aget loads it back (vectors memory-mapped)
+
+    async def aget(self, file_id):
+        """The stored record for this hash (loading it from store_dir if needed), or None."""
+        record = self.files.get(file_id)
+        if record is None and self.store_dir:
+            record = await asyncio.to_thread(self._load, file_id)
+        if record is not None:
+            self._remember(file_id, record)
+        return record
+
+    async def _ingest(self, file_id, path, name):
+        start = time.perf_counter()
+        record = {"name": name, "chunks": [], "token_counts": [], "tokens": 0, "index": FlatIndex(capacity=64)}
+        async for pieces, tokens in self._chunks(path):
+            vectors = await self.embeddings.aembed_documents(pieces)
+            ids = [f"{file_id}:{len(record['chunks']) + i}" for i in range(len(pieces))]
+            record["index"].add(ids, vectors)
+            record["chunks"].extend(pieces)
+            record["token_counts"].extend(tokens)
+        record["tokens"] = sum(record["token_counts"])
+        ids = [f"{file_id}:{i}" for i in range(len(record["chunks"]))]
+        if ids: # the index grows geometrically while ingesting; copy it into an exactly-sized one
+            index = FlatIndex()
+            index.load_matrix(ids, np.ascontiguousarray(record["index"].get_vectors(ids)))
+            record["index"] = index
+        if self.store_dir:
+            await asyncio.to_thread(self._save, file_id, record)
+        self._remember(file_id, record)
+        self.ingested += 1
+        print(f"=== Indexed {name}: {len(record['chunks'])} chunks, {record['tokens']} tokens in {time.perf_counter() - start:.2f}s ===")
+        return record
+
+    async def aadd_file(self, path, name=None):
+        """Store a file (unless it's already stored). Returns its sha256 and its record; the record is returned because
+        other files being added meanwhile can already have evicted it from self.files."""
+        file_id = await asyncio.to_thread(sha256_file, path)
+        record = await self.aget(file_id)
+        if record is not None:
+            self.reused += 1
+            print(f"=== {name or path} is already stored, reusing it ===")
+            return file_id, record
+        task = self.pending.get(file_id)
+        if task is None:
+            task = asyncio.ensure_future(self._ingest(file_id, path, name or path))
+            self.pending[file_id] = task
+            task.add_done_callback(lambda _: self.pending.pop(file_id, None))
+        return file_id, await asyncio.shield(task)
+
+    def reference(self, file_id, record, name=None):
+        """A small message standing in for the file in the chat history; ContextBuilder.abuild expands it.
+        record is the one aadd_file returned."""
+        return HumanMessage(
+            content=(f"Attached file {name or record['name']} ({record['tokens']} tokens in {len(record['chunks'])} parts). "
+                     "The parts relevant to each question are added to the context."),
+            additional_kwargs={"attachment": file_id},
+        )
+
+    async def asearch(self, query, file_ids, k=5):
+        """The k chunks from these files most similar to query, as (file id, chunk number, score), best first."""
+        return [(file_id, number, score) for file_id, number, score, _ in await self._search(query, file_ids, k)]
+
+    async def _search(self, query, file_ids, k):
+        """asearch hits with the file's record as well, so callers don't depend on it still being in self.files."""
+        records = {file_id: await self.aget(file_id) for file_id in file_ids}
+        records = {file_id: record for file_id, record in records.items() if record is not None and record["chunks"]}
+        if not records:
+            return []
+        vector = await self.embeddings.aembed_query(query)
+        hits = []
+        for file_id, record in records.items():
+            for chunk_id, score in record["index"].search(vector, k):
+                hits.append((file_id, int(chunk_id.rsplit(":", 1)[1]), score, record))
+        hits.sort(key=lambda hit: -hit[2])
+        return hits[:k]
+
+    async def arelevant_messages(self, query, file_ids, k=5):
+        """The top chunks for query as messages, in file order, ready for ContextBuilder.build(attachments=...)."""
+        hits = sorted(await self._search(query, file_ids, k), key=lambda hit: (file_ids.index(hit[0]), hit[1]))
+        messages = []
+        for file_id, number, _, record in hits:
+            messages.append(HumanMessage(
+                content=f"From attached file {record['name']} (part {number + 1} of {len(record['chunks'])}):\n{record['chunks'][number]}"
+            ))
+        return messages
+
+    def stats(self):
+        return {"files": len(self.files), "ingested": self.ingested, "reused": self.reused}
+
+
+async def ingest_files(message, store):
+    """Store the text files attached to a Chainlit message. Returns a reference message for each, to put in the history."""
+    references = []
+    for element in message.elements or []:
+        if is_text_file(element):
+            name = element.name or "(unknown file name)"
+            file_id, record = await store.aadd_file(element.path, name)
+            references.append(store.reference(file_id, record, name))
+    return references
@@ -6,7 +6,12 @@
 import json
 import chainlit as cl
 from langchain_core.tools import tool 
-from tools import create_react_tool_agent
+from tools import create_react_tool_agent, get_embeddings
+from context_tools import ContextBuilder
+from mem0_tools import CachedEmbeddings
+from attachment_tools import AttachmentStore, ingest_files
+from cache_tools import ResponseCache
+from chainlit_tools import SessionStore, stream_agent_response
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 import app_memory_hook
 
@@ -15,8 +20,15 @@ with open("config.json", "r") as f:
 
 model = config["openai"]["default_model"]
 api_key = config["openai"]["api_key"]
+max_context_tokens = config.get("context", {}).get("max_tokens", 100_000)
 
-chat_history = []
+sessions = SessionStore(**config.get("sessions", {})) # history per chat, instead of one global list
+embedding_model = "text-embedding-3-small"
+embeddings = CachedEmbeddings(get_embeddings(model=embedding_model, api_key=api_key), model=embedding_model)
+# files are stored once by content hash and shared by all sessions
+attachments = AttachmentStore(embeddings, model=model, store_dir=config.get("attachments", {}).get("store_dir", "attachment_store"))
+context_builder = ContextBuilder(max_tokens=max_context_tokens, model=model, attachment_store=attachments)
+response_cache = ResponseCache(model, **config.get("response_cache", {})) # exact repeats skip the LLM
 
 @tool
 def long_division(dividend: int, divisor: int) -> str:
@@ -35,12 +47,13 @@ agent = create_react_tool_agent(
 )
 
 # So I can see these variables from a notebook running this app as a thread
-app_memory_hook.chat_history = chat_history
+app_memory_hook.sessions = sessions
 app_memory_hook.agent = agent
+app_memory_hook.response_cache = response_cache
 
 @cl.on_chat_start
 async def on_chat_start():   
-    chat_history.clear()  # Clear chat history at the start of each chat  
+    chat_history = sessions.reset().history  # Fresh history at the start of each chat
     intro_message = AIMessage(f"Welcome to the Chainlit app! I can perform long division and read file attachments. Try sending me a message or attaching a file.")
     chat_history.append(intro_message)
     await cl.Message(content=intro_message.content).send()
@@ -50,20 +63,19 @@ async def on_chat_start():
 async def on_message(message: cl.Message):
     print(f"=== MESSAGE RECEIVED: {message.content} ===")
     input = message.content
-    if message.elements:
+    chat_history = sessions.current().history
+    # Attachments are stored once by content hash (read off the event loop, chunked and indexed);
+    # the history just gets a small reference to each, which the context builder expands into the relevant chunks
+    file_references = await ingest_files(message, attachments)
+    if file_references:
         print("=== FILE ATTACHMENTS RECEIVED ===")
-        for element in message.elements:
-            if element.type == "file" and (element.mime == "text/plain" or not element.mime): 
-                file_name = element.name if element.name else "(unknown file name)"
-                with open(element.path, "r") as f:
-                    file_text = f.read()
-                file_input = f"File name: {file_name}\nFile content:\n{file_text}"
-                chat_history.append(HumanMessage(content=file_input))
+        chat_history.extend(file_references)
     
-    response = await agent.ainvoke({
+    # Tokens and tool calls show up in the UI as they happen
+    response = await stream_agent_response(agent, {
         "input": input,
-        "chat_history": chat_history,
-    })
+        "chat_history": await context_builder.abuild(input, history=chat_history), # the newest messages that fit the budget
+    }, cache=response_cache)
     output = response["output"]
     if response["intermediate_steps"]:
         print("=== INTERMEDIATE STEPS ===")
@@ -73,6 +85,9 @@ async def on_message(message: cl.Message):
     chat_history.append(HumanMessage(content=input))
     chat_history.append(AIMessage(content=output))
 
-    print(f"=== SENDING RESPONSE: {output} ===")
-    # Send the response back to the user
-    await cl.Message(content=output).send()
+    print(f"=== SENT RESPONSE: {output} ===")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    sessions.drop() # every chat starts over with a fresh state, so don't keep this one (or its spill file) around
@@ -0,0 +1,184 @@
+## Caching agent answers for repeated (or nearly repeated) questions, and tool results shared between sessions
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from vector_tools import FlatIndex
+
+
+def _normalize(text):
+    return " ".join(str(text).split()).casefold()
+
+
+class ResponseCache:
+    """Caches agent outputs.
+
+    The exact tier is keyed on the normalized (model, system prompt, last history_turns messages, input).
+    With embeddings, a semantic tier also returns a cached answer whose input is at least similarity_threshold
+    similar to this one, as long as the rest of the context matches exactly.
+    Entries expire after ttl_seconds, and the least recently used go once there are more than max_entries.
+    Answers that used any tool named in bypass_tools (e.g. web search) are never cached.
+    """
+    def __init__(self, model, ttl_seconds=3600, max_entries=1000, history_turns=4,
+                 embeddings=None, similarity_threshold=0.95, bypass_tools=()):
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.history_turns = history_turns
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.bypass_tools = {getattr(tool, "name", tool) for tool in bypass_tools}
+        self.entries = OrderedDict() # key -> {"output", "context", "created"}
+        self.index = FlatIndex() if embeddings is not None else None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def _context_key(self, inputs):
+        history = list(inputs.get("chat_history", []))
+        system = [m for m in history if m.type == "system"]
+        recent = [m for m in history if m.type != "system"][-self.history_turns:] if self.history_turns else []
+        parts = [self.model] + [f"{m.type}: {_normalize(m.content)}" for m in system + recent]
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def _key(self, context, inputs):
+        return hashlib.sha256(f"{context}\n{_normalize(inputs['input'])}".encode("utf-8")).hexdigest()
+
+    def _live(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["created"] > self.ttl_seconds:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        del self.entries[key]
+        if self.index is not None:
+            self.index.delete([key])
+
+    async def alookup(self, inputs):
+        """The cached output for these agent inputs, or None."""
+        context = self._context_key(inputs)
+        entry = self._live(self._key(context, inputs))
+        if entry is not None:
+            self.exact_hits += 1
+            return entry["output"]
+        if self.index is not None and len(self.index):
+            vector = await self.embeddings.aembed_query(_normalize(inputs["input"]))
+            for key, score in self.index.search(vector, k=5):
+                if score < self.similarity_threshold:
+                    break
+                entry = self._live(key)
+                if entry is not None and entry["context"] == context:
+                    self.semantic_hits += 1
+                    return entry["output"]
+        self.misses += 1
+        return None
+
+    async def astore(self, inputs, response):
+        """Remember an agent response (the dict from ainvoke), unless it used a bypassed tool."""
+        used_tools = {action.tool for action, _ in response.get("intermediate_steps", [])}
+        if used_tools & self.bypass_tools:
+            self.bypassed += 1
+            return
+        context = self._context_key(inputs)
+        key = self._key(context, inputs)
+        self.entries[key] = {"output": response["output"], "context": context, "created": time.time()}
+        self.entries.move_to_end(key)
+        if self.index is not None:
+            self.index.add([key], [await self.embeddings.aembed_query(_normalize(inputs["input"]))])
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    async def ainvoke(self, agent, inputs):
+        """agent.ainvoke with the cache in front of it, for callers that don't stream."""
+        output = await self.alookup(inputs)
+        if output is not None:
+            return {"output": output, "intermediate_steps": [], "cached": True}
+        response = await agent.ainvoke(inputs)
+        await self.astore(inputs, response)
+        return response
+
+    def stats(self):
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+
+class ToolResultCache:
+    """TTL + LRU cache for tool results that can be shared between sessions (web searches, page extracts).
+
+    fetch() also coalesces: while a call for some key is in flight, identical calls wait for it instead of
+    making their own request. The shared call runs in its own task, so one caller giving up doesn't cancel it
+    for the others. Exceptions and error results are passed on but not cached, and neither are partial failures
+    (an extract where some URLs failed), so the next call tries the failed ones again.
+    """
+    def __init__(self, ttl_seconds=900, max_entries=1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (created, result)
+        self.inflight = {} # key -> task fetching it
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl_seconds:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, result):
+        self.entries[key] = (time.time(), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def _fetch(self, key, fetch):
+        try:
+            result = await fetch()
+            # Tavily tools return {"error": ...} on failure, and TavilyExtract lists the URLs it couldn't get in failed_results
+            if not (isinstance(result, dict) and ("error" in result or result.get("failed_results"))):
+                self.put(key, result)
+            return result
+        finally:
+            del self.inflight[key]
+
+    async def fetch(self, key, fetch):
+        """The cached result for key, or the result of awaiting fetch() (shared with any identical calls in flight)."""
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        task = self.inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self.inflight[key] = task
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        calls = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / calls if calls else 0.0,
+            "entries": len(self.entries),
+        }
@@ -1,26 +1,214 @@
 import os
 import json
+import time
+import asyncio
+from collections import OrderedDict
 import chainlit as cl
 from chainlit.input_widget import Select
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-
-def files_to_messages(msg):
-    if not msg.elements:
-        return []
-    messages = []
-    for element in msg.elements:
-        if element.type == "file" and (element.mime == "text/plain" or not element.mime):
-            file_name = element.name if element.name else "(unknown file name)"
-            with open(element.path, "r") as f:
-                file_text = f.read()
-            file_input = f"File name: {file_name}\nFile content:\n{file_text}"
-            messages.append(HumanMessage(content=file_input))
-    return messages
+from langchain_core.messages import messages_to_dict, messages_from_dict
+from thread_tools import ThreadStore, ThreadSearch, ARCHIVE_EXTENSIONS, AUTOSAVE_PREFIX, load_thread_file, thread_name_from_path
+
+async def stream_agent_response(agent, inputs, cache=None, **message_kwargs):
+    """Run an AgentExecutor with astream_events, streaming the answer into a cl.Message token by token
+    and showing each tool call as a cl.Step while it runs. message_kwargs go to cl.Message (e.g. actions).
+    With a cache (cache_tools.ResponseCache), a cached answer is sent straight away and new answers are stored.
+    Returns what agent.ainvoke would have: a dict with "output" and "intermediate_steps"."""
+    if cache is not None:
+        output = await cache.alookup(inputs)
+        if output is not None:
+            await cl.Message(content=output, **message_kwargs).send()
+            print(f"=== Response cache hit ({cache.stats()['hit_rate']:.0%} hit rate) ===")
+            return {"output": output, "intermediate_steps": []}
+    msg = cl.Message(content="", **message_kwargs)
+    steps = {} # run_id -> cl.Step
+    result = {}
+    start = time.perf_counter()
+    first_token_at = None
+    async for event in agent.astream_events(inputs, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream":
+            token = event["data"]["chunk"].content
+            if token and isinstance(token, str):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                await msg.stream_token(token)
+        elif kind == "on_tool_start":
+            step = cl.Step(name=event["name"], type="tool")
+            step.input = event["data"].get("input")
+            await step.send()
+            steps[event["run_id"]] = step
+        elif kind == "on_tool_end":
+            step = steps.pop(event["run_id"], None)
+            if step:
+                step.output = str(event["data"].get("output"))
+                await step.update()
+        elif kind == "on_chain_end" and not event.get("parent_ids"):
+            result = event["data"].get("output") or {}
+    for step in steps.values(): # tools that were cancelled (e.g. timed out) never send on_tool_end
+        step.output = "(no result)"
+        await step.update()
+    output = result.get("output", msg.content)
+    msg.content = output # in case the model said something before calling a tool
+    await msg.send()
+    total = time.perf_counter() - start
+    if first_token_at is not None:
+        # with ainvoke the user saw nothing until the whole thing was done, i.e. time to first token == total
+        print(f"=== Time to first token: {first_token_at - start:.2f}s (full response {total:.2f}s) ===")
+    response = {"output": output, "intermediate_steps": result.get("intermediate_steps", [])}
+    if cache is not None:
+        await cache.astore(inputs, response)
+    return response
+
+def current_session_id():
+    """The Chainlit thread id (stable across reconnects), or the session id if there isn't one."""
+    session = cl.context.session
+    return getattr(session, "thread_id", None) or session.id
+
+class SessionState:
+    """Everything we keep for one chat: its history, how much of it has been summarized, and whose memories it uses.
+    A chat resumed from a saved thread also knows the thread's name, and history_offset: how many of the thread's
+    older messages are still only in the store (history[0] is message number history_offset of the thread)."""
+    def __init__(self, session_id, history=None, summary="", summarized_count=0, memory_namespace=None,
+                 thread_name=None, history_offset=0):
+        self.session_id = session_id
+        self.history = history if history is not None else []
+        self.summary = summary
+        self.summarized_count = summarized_count
+        self.memory_namespace = memory_namespace or session_id
+        self.thread_name = thread_name
+        self.history_offset = history_offset
+        self.last_used = time.time()
+
+    def to_dict(self):
+        return {
+            "session_id": self.session_id,
+            "history": messages_to_dict(self.history),
+            "summary": self.summary,
+            "summarized_count": self.summarized_count,
+            "memory_namespace": self.memory_namespace,
+            "thread_name": self.thread_name,
+            "history_offset": self.history_offset,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["session_id"],
+            history=messages_from_dict(data["history"]),
+            summary=data["summary"],
+            summarized_count=data["summarized_count"],
+            memory_namespace=data["memory_namespace"],
+            thread_name=data.get("thread_name"),
+            history_offset=data.get("history_offset", 0),
+        )
+
+class SessionStore:
+    """Per-session state keyed by Chainlit thread/session id, instead of one module-level chat_history for everyone.
+
+    Keeps at most max_sessions in memory (least recently used go first) and evicts sessions idle for ttl_seconds.
+    Evicted sessions are written to spill_dir and reloaded the next time they're used.
+    With spill_dir=None nothing is ever evicted, since that would silently throw live chats away.
+    Call drop() when a chat ends; spill files of chats that never came back are deleted after spill_max_age seconds.
+    """
+    def __init__(self, max_sessions=1000, ttl_seconds=3600, spill_dir="session_spill", spill_max_age=7 * 24 * 3600):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.spill_dir = spill_dir
+        self.spill_max_age = spill_max_age
+        self.sessions = OrderedDict()
+        self.last_prune = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, session_id):
+        safe_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in session_id)
+        return os.path.join(self.spill_dir, f"{safe_id}.json")
+
+    def get(self, session_id):
+        """The state for session_id, reloaded from disk or created if we don't have it in memory."""
+        state = self.sessions.get(session_id)
+        if state is None:
+            state = self._unspill(session_id) or SessionState(session_id)
+            self.sessions[session_id] = state
+        self.sessions.move_to_end(session_id)
+        state.last_used = time.time()
+        self._evict()
+        return state
+
+    def current(self):
+        return self.get(current_session_id())
+
+    def reset(self, session_id=None):
+        """Start session_id (default: the current one) over with a fresh state."""
+        session_id = session_id or current_session_id()
+        self.drop(session_id)
+        return self.get(session_id)
+
+    def drop(self, session_id=None):
+        """Forget session_id (default: the current one), on disk too."""
+        session_id = session_id or current_session_id()
+        self.sessions.pop(session_id, None)
+        if self.spill_dir and os.path.exists(self._spill_path(session_id)):
+            os.remove(self._spill_path(session_id))
+
+    def _evict(self):
+        if not self.spill_dir:
+            return
+        if time.time() - self.last_prune > self.ttl_seconds: # at most every ttl_seconds, it's a directory listing
+            self._prune_spill()
+        cutoff = time.time() - self.ttl_seconds
+        while self.sessions:
+            session_id, state = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and state.last_used >= cutoff:
+                break
+            del self.sessions[session_id]
+            self._spill(state)
+
+    def _prune_spill(self):
+        """Delete spill files not written to for spill_max_age seconds."""
+        self.last_prune = time.time()
+        cutoff = self.last_prune - self.spill_max_age
+        removed = 0
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        if removed:
+            print(f"=== Deleted {removed} session spill files older than {self.spill_max_age / 86400:g} days ===")
+
+    def _spill(self, state):
+        path = self._spill_path(state.session_id)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state.to_dict(), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _unspill(self, session_id):
+        if not self.spill_dir or not os.path.exists(self._spill_path(session_id)):
+            return None
+        path = self._spill_path(session_id)
+        with open(path, "r", encoding="utf-8") as f:
+            state = SessionState.from_dict(json.load(f))
+        os.remove(path)
+        return state
+
 
 class ChatHistorySaver:
-    def __init__(self, subdir="saved_threads"):
+    """Save/load actions for named threads, kept in a thread_tools.ThreadStore (subdir/threads.sqlite).
+    Files in subdir (old whole-file *.json saves, or compressed archives from thread_tools.write_archive)
+    still show up in the list, and are imported into the store when loaded.
+    Loading only brings in the newest page_size messages (plus the thread's stored summary);
+    load_earlier() pages older ones in when they're wanted, e.g. from show_earlier_action.
+    search_action finds threads by keyword (and by meaning, if embeddings are given) instead of by name.
+    Threads written by a thread_tools.Autosaver (names starting with autosave_prefix) are only for getting a chat
+    back after a crash, so the list just shows the newest max_autosaves of them."""
+    def __init__(self, subdir="saved_threads", page_size=50, embeddings=None, autosave_prefix=AUTOSAVE_PREFIX, max_autosaves=5):
         self.subdir = subdir
+        self.page_size = page_size
+        self.autosave_prefix = autosave_prefix
+        self.max_autosaves = max_autosaves
         os.makedirs(self.subdir, exist_ok=True)
+        self.store = ThreadStore(os.path.join(self.subdir, "threads.sqlite"))
+        self.search = ThreadSearch(self.store, embeddings)
         self.save_action = cl.Action(
             name="save_chat_history",
             icon="hard-drive-download",
@@ -33,11 +221,24 @@ class ChatHistorySaver:
             payload={"action": "load"},
             label="Load Chat History"
         )
+        self.show_earlier_action = cl.Action(
+            name="show_earlier_messages",
+            icon="history",
+            payload={"action": "earlier"},
+            label="Show Earlier Messages"
+        )
+        self.search_action = cl.Action(
+            name="search_chat_history",
+            icon="search",
+            payload={"action": "search"},
+            label="Search Saved Threads"
+        )
     
     async def work_around_end_task_bug(self):
         await cl.context.emitter.task_end()
 
-    async def save_chat_history(self, chat_history):
+    async def save_chat_history(self, state):
+        """Ask for a name and save state's history as that thread. Returns True if it was saved."""
         name_msg = await cl.AskUserMessage(
             content="Please type a name for this chat history, or leave blank to cancel:",
             raise_on_timeout=False,
@@ -46,72 +247,183 @@ class ChatHistorySaver:
         if not name_msg or not name_msg["output"]:
             await cl.Message("Cancelled: no name provided.").send()
             await self.work_around_end_task_bug()
-            return
+            return False
         else:
-            raw_name = name_msg["output"]
-
-        filename = raw_name + ".json"
-        filepath = os.path.join(self.subdir, filename)
-
-        if os.path.exists(filepath):
-            overwrite = await cl.AskActionMessage(
-                content=(f"A file named **{filename}** already exists. "
-                         "Overwrite it?"),
-                actions=[
-                    cl.Action(name="ow_yes", label="✅ Overwrite", payload=True),
-                    cl.Action(name="ow_no",  label="❌ Choose new name", payload=False),
-                ],
-            ).send()
+            name = name_msg["output"]
 
-            if not overwrite or not overwrite["payload"]:
-                await cl.Message("Save cancelled.").send()
-                await self.work_around_end_task_bug()
-                return
+        # saving back into the thread this chat was loaded from just continues it, no need to ask
+        overwrite = False
+        if name != state.thread_name and await self.store.aexists(name):
+            if not await self._confirm_overwrite(f"A thread named **{name}** already exists. Overwrite it?"):
+                return False
+            overwrite = True
 
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump([m.dict() for m in chat_history], f, indent=2, ensure_ascii=False)
-
-        await cl.Message(f"✅ Chat history saved to `{filepath}`").send()
+        history, offset = state.history, state.history_offset
+        if offset and name != state.thread_name:
+            # a copy under a new name needs the messages that were never paged in
+            history = (await self.store.aload_page(state.thread_name, offset, offset)) + history
+            offset = 0
+        # if the saved thread is the start of this one (e.g. saving again later), only the new messages get written
+        try:
+            written = await self.store.asave(name, history, offset, summary=state.summary or None, overwrite=overwrite)
+        except ValueError: # the thread was changed elsewhere (another chat, or its autosave) since this chat loaded it
+            if not await self._confirm_overwrite(f"**{name}** was changed by another chat since this one loaded it. "
+                                                 "Overwrite it with this chat?"):
+                return False
+            if offset: # rewriting it needs the whole thread
+                history = (await self.store.aload_page(name, offset, offset)) + history
+                offset = 0
+            written = await self.store.asave(name, history, offset, summary=state.summary or None, overwrite=True)
+        state.thread_name = name
+        # the keyword index was updated with the save; new messages get their vectors in the background
+        self.search.schedule_update()
+        await cl.Message(f"✅ Chat history saved as **{name}** ({written} new messages written)").send()
         await self.work_around_end_task_bug()
-        
+        return True
 
-    async def load_chat_history(self):
-        new_history = []
-        files = [f for f in os.listdir(self.subdir) if f.endswith(".json")]
-        if not files:
+    async def _confirm_overwrite(self, content):
+        """Ask before replacing a saved thread; tells the user the save was cancelled if they say no."""
+        overwrite = await cl.AskActionMessage(
+            content=content,
+            actions=[
+                cl.Action(name="ow_yes", label="✅ Overwrite", payload={"overwrite": True}),
+                cl.Action(name="ow_no",  label="❌ Choose new name", payload={"overwrite": False}),
+            ],
+        ).send()
+        if not overwrite or not overwrite["payload"].get("overwrite"):
+            await cl.Message("Save cancelled.").send()
+            await self.work_around_end_task_bug()
+            return False
+        return True
+
+    def _legacy_files(self, stored_names):
+        """Thread files not in the store yet, one per thread name (the archive, if an old save has been converted)."""
+        files = {}
+        for f in sorted(os.listdir(self.subdir)):
+            name = thread_name_from_path(f)
+            if f.endswith(ARCHIVE_EXTENSIONS + (".json",)) and name not in stored_names:
+                if name not in files or f.endswith(ARCHIVE_EXTENSIONS):
+                    files[name] = f
+        return list(files.values())
+
+    def _load_legacy_file(self, filename):
+        """Read a thread file (any format thread_tools.load_thread_file knows) and import it into the store."""
+        history = load_thread_file(os.path.join(self.subdir, filename))
+        self.store.save(thread_name_from_path(filename), history)
+        return history
+
+    async def load_chat_history(self, state):
+        """Let the user pick a thread and resume it in state: the newest page_size messages and the stored summary.
+        Returns True if a thread was loaded."""
+        threads = await self.store.alist_threads()
+        legacy = await asyncio.to_thread(self._legacy_files, {thread["name"] for thread in threads})
+        autosaves = [thread for thread in threads if thread["name"].startswith(f"{self.autosave_prefix} ")]
+        threads = [thread for thread in threads if not thread["name"].startswith(f"{self.autosave_prefix} ")] + autosaves[:self.max_autosaves]
+        if not threads and not legacy:
             await cl.Message(content="No saved threads found.").send()
-            return
+            return False
 
+        # the labels come from the index table, no thread has to be opened to list them
         actions = [
-            cl.Action(name=f"file_{i}", label=f, icon="file", payload={"value": f})
-            for i, f in enumerate(files)
+            cl.Action(name=f"thread_{i}", label=f"{thread['name']} ({thread['message_count']} messages)", icon="file",
+                      payload={"thread": thread["name"]})
+            for i, thread in enumerate(threads)
+        ] + [
+            cl.Action(name=f"file_{i}", label=f, icon="file", payload={"file": f})
+            for i, f in enumerate(legacy)
         ]
         actions.append(cl.Action(name="cancel_load", label="❌ Cancel", payload={"value": "cancel"}))
 
         selected = await cl.AskActionMessage(
-            content="Select a chat-history file to load:",
+            content="Select a chat history to load:",
             actions=actions,
         ).send()
         if not selected or selected["name"] == "cancel_load":
             await cl.Message(content="Selection cancelled.").send()
             await self.work_around_end_task_bug()
-            return None
+            return False
+
+        payload = selected["payload"]
+        return await self._resume(state, payload.get("thread") or payload.get("file"), from_file="file" in payload)
 
-        filename = selected["payload"]["value"]
-        path = os.path.join(self.subdir, filename)
+    async def _resume(self, state, name, from_file=False):
+        loaded = False
         try:
-            with open(path, "r") as f:
-                history = json.load(f)
-
-            for msg in history:
-                if msg["type"] == "human":
-                    new_history.append(HumanMessage(**msg))
-                elif msg["type"] == "ai":
-                    new_history.append(AIMessage(**msg))
-                elif msg["type"] == "system":
-                    new_history.append(SystemMessage(**msg))
-            await cl.Message(content=f"Loaded history from **{filename}**").send()
+            if from_file:
+                await asyncio.to_thread(self._load_legacy_file, name)
+                name = thread_name_from_path(name)
+            thread = await self.store.aload_recent(name, self.page_size)
+            state.history[:] = thread["messages"]
+            state.history_offset = thread["offset"]
+            state.thread_name = name
+            state.summary, state.summarized_count = thread["summary"] or "", 0
+            loaded = True
+            earlier = f", {thread['offset']} earlier messages not loaded yet" if thread["offset"] else ""
+            await cl.Message(
+                content=f"Loaded the last {len(thread['messages'])} messages of **{name}**{earlier}",
+                actions=[self.show_earlier_action] if thread["offset"] else [],
+            ).send()
         except Exception as e:
-            await cl.Message(content=f"Error loading file: {e}").send()
+            await cl.Message(content=f"Error loading thread: {e}").send()
         await self.work_around_end_task_bug()
-        return new_history
\ No newline at end of file
+        return loaded
+
+    async def search_chat_history(self, state, limit=10):
+        """Ask for a query, show the best matching messages from all saved threads, and resume the thread picked.
+        Returns True if a thread was loaded."""
+        query_msg = await cl.AskUserMessage(
+            content="What are you looking for? (leave blank to cancel)",
+            raise_on_timeout=False,
+        ).send()
+        if not query_msg or not query_msg["output"].strip():
+            await cl.Message("Search cancelled.").send()
+            await self.work_around_end_task_bug()
+            return False
+
+        start = time.perf_counter()
+        hits = await self.search.asearch(query_msg["output"], limit)
+        print(f"=== Thread search for {query_msg['output']!r}: {len(hits)} hits in {(time.perf_counter() - start) * 1000:.1f}ms ===")
+        if not hits:
+            await cl.Message("No saved messages match that.").send()
+            await self.work_around_end_task_bug()
+            return False
+
+        lines = [f"**{hit['thread']}** (message {hit['seq'] + 1}): {hit['snippet']}" for hit in hits]
+        threads = list(dict.fromkeys(hit["thread"] for hit in hits)) # best match first, each thread once
+        actions = [cl.Action(name=f"found_{i}", label=name, icon="file", payload={"thread": name}) for i, name in enumerate(threads)]
+        actions.append(cl.Action(name="cancel_load", label="❌ Cancel", payload={"value": "cancel"}))
+        selected = await cl.AskActionMessage(
+            content="\n\n".join(lines) + "\n\nLoad one of these threads?",
+            actions=actions,
+        ).send()
+        if not selected or selected["name"] == "cancel_load":
+            await cl.Message(content="Selection cancelled.").send()
+            await self.work_around_end_task_bug()
+            return False
+        return await self._resume(state, selected["payload"]["thread"])
+
+    async def load_earlier(self, state, n=None):
+        """Page up to n (default page_size) older messages of the loaded thread into the front of state.history.
+        Returns the messages paged in."""
+        if not state.thread_name or not state.history_offset:
+            return []
+        older = await self.store.aload_page(state.thread_name, state.history_offset, n or self.page_size)
+        state.history[:0] = older
+        state.history_offset -= len(older)
+        if state.summarized_count:
+            state.summarized_count += len(older) # it counts from the start of history, which just moved
+        return older
+
+    async def show_earlier(self, state, preview_chars=300):
+        """Page in the previous page of messages and show them."""
+        older = await self.load_earlier(state)
+        if not older:
+            await cl.Message(content="There are no earlier messages.").send()
+            return
+        speakers = {"human": "You", "ai": "Assistant", "system": "System"}
+        lines = [f"**{speakers.get(m.type, m.type)}:** {m.content[:preview_chars]}{'…' if len(m.content) > preview_chars else ''}"
+                 for m in older]
+        await cl.Message(
+            content=f"Earlier messages ({len(older)}):\n\n" + "\n\n".join(lines),
+            actions=[self.show_earlier_action] if state.history_offset else [],
+        ).send()
@@ -0,0 +1,116 @@
+## Fitting what we send to the agent into the model's context window
+from collections import OrderedDict
+from langchain_core.messages import SystemMessage
+from tools import count_tokens, truncate_tokens
+from attachment_tools import referenced_files
+
+_message_overhead = 4 # tokens the chat format adds around each message, roughly
+
+class ContextBuilder:
+    """Packs system prompt, summary, memories, recent turns and attachments into a token budget.
+
+    Sections are filled in priority order, each getting whatever budget is left after the ones before it.
+    The current input always goes in. Single-text sections (system, summary, memories, attachments) are truncated
+    to fit, and attachments never get more than attachment_share of what's left, so a big file can't crowd out
+    the conversation. History is added newest-first and stops at the first message that doesn't fit.
+    Token counts are cached per message, so re-packing a long conversation each turn only counts the new messages.
+    With an attachment_store, abuild also expands the attachment references in the history it keeps.
+    """
+    default_priorities = ("system", "attachments", "memories", "summary", "history")
+
+    def __init__(self, max_tokens=100_000, model="gpt-4.1", reserve_tokens=4_000, priorities=None,
+                 attachment_share=0.5, max_cache_items=50_000, attachment_store=None):
+        self.max_tokens = max_tokens
+        self.model = model
+        self.reserve_tokens = reserve_tokens # left free for the response (and the tool-call scratchpad)
+        self.priorities = priorities or self.default_priorities
+        self.attachment_share = attachment_share
+        self.max_cache_items = max_cache_items
+        self.token_counts = OrderedDict()
+        self.attachment_store = attachment_store
+
+    def count(self, text):
+        """Token count for a piece of text, cached (Python caches string hashes, so repeat lookups are cheap)."""
+        if text in self.token_counts:
+            self.token_counts.move_to_end(text)
+            return self.token_counts[text]
+        tokens = count_tokens(text, self.model)
+        self.token_counts[text] = tokens
+        if len(self.token_counts) > self.max_cache_items:
+            self.token_counts.popitem(last=False)
+        return tokens
+
+    def message_tokens(self, message):
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        return self.count(content) + _message_overhead
+
+    def _fit(self, message, budget):
+        """The message if it fits in budget, a truncated copy if only part of it does, or None."""
+        tokens = self.message_tokens(message)
+        if tokens <= budget:
+            return message, tokens
+        room = budget - _message_overhead
+        if room <= 0:
+            return None, 0
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        content = truncate_tokens(content, room, self.model) + "\n[...truncated to fit the context window]"
+        truncated = message.__class__(content=content)
+        return truncated, self.message_tokens(truncated)
+
+    def build(self, input, history=(), system_prompt=None, summary=None, memories=None, attachments=None):
+        """Return the chat_history to send with input. memories can be MemoryItems or strings,
+        attachments are messages (e.g. from AttachmentStore.arelevant_messages)."""
+        messages, dropped = self._pack(input, history, system_prompt, summary, memories, attachments)
+        if dropped:
+            print(f"Context budget: left out the {dropped} oldest messages")
+        return messages
+
+    async def abuild(self, input, history=(), system_prompt=None, summary=None, memories=None, attachments=None, k=5):
+        """Like build, but files referenced by history messages that made it into the budget get their k chunks
+        most relevant to input added to attachments. References that fell out of the window aren't expanded."""
+        messages, dropped = self._pack(input, history, system_prompt, summary, memories, attachments)
+        file_ids = referenced_files(messages) if self.attachment_store else []
+        if file_ids:
+            chunks = await self.attachment_store.arelevant_messages(input, file_ids, k)
+            messages, dropped = self._pack(input, history, system_prompt, summary, memories, list(attachments or []) + chunks)
+        if dropped:
+            print(f"Context budget: left out the {dropped} oldest messages")
+        return messages
+
+    def _pack(self, input, history, system_prompt, summary, memories, attachments):
+        budget = self.max_tokens - self.reserve_tokens - self.count(input) - _message_overhead
+        sections = {}
+        if system_prompt:
+            sections["system"] = [system_prompt if isinstance(system_prompt, SystemMessage) else SystemMessage(content=system_prompt)]
+        if summary:
+            sections["summary"] = [SystemMessage(content=f"Summary of the earlier conversation:\n{summary}")]
+        if memories:
+            texts = [memory if isinstance(memory, str) else memory.text for memory in memories]
+            sections["memories"] = [SystemMessage(content="\n".join(texts))]
+        if attachments:
+            sections["attachments"] = list(attachments)
+
+        packed = {}
+        for name in self.priorities:
+            if name == "history":
+                recent = []
+                for message in reversed(history):
+                    tokens = self.message_tokens(message)
+                    if tokens > budget:
+                        break
+                    recent.append(message)
+                    budget -= tokens
+                packed["history"] = recent[::-1]
+                continue
+            packed[name] = []
+            section_budget = int(budget * self.attachment_share) if name == "attachments" else budget
+            for message in sections.get(name, []):
+                message, tokens = self._fit(message, section_budget)
+                if message is None:
+                    break
+                packed[name].append(message)
+                section_budget -= tokens
+                budget -= tokens
+        dropped = len(history) - len(packed.get("history", []))
+        order = ("system", "summary", "memories", "history", "attachments")
+        return [message for name in order for message in packed.get(name, [])], dropped
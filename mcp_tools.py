@@ -0,0 +1,266 @@
+## Long-lived MCP sessions, so each tool call doesn't spawn a fresh server process
+# MultiServerMCPClient.get_tools() returns tools that open a new session (for stdio: a new npx subprocess) per call.
+# MCPSessionPool starts each configured server once, the first time it's needed, and sends every call over that session.
+# With a schema_cache_dir, load_tools() builds the tools from the schemas saved last time and re-lists them in the background,
+# so startup doesn't wait for npx.
+import os
+import sys
+import json
+import time
+import hashlib
+import asyncio
+import anyio
+from langchain_core.tools import StructuredTool, ToolException
+from langchain_mcp_adapters.sessions import create_session
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
+
+# what a dead or dying server looks like from the client side
+_connection_errors = (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream, ConnectionError)
+# what sending a request over an already-closed session raises: the request never left, so it's safe to send again
+_send_errors = (anyio.ClosedResourceError, anyio.BrokenResourceError)
+
+
+class MCPSessionPool:
+    """One open MCP ClientSession per server, shared by all tool calls (MCP requests are multiplexed by id).
+
+    connections is the same dict MultiServerMCPClient takes. A server is started on first use (or by start()),
+    restarted if it crashes, and shut down by close(). Each session lives in its own task, because the MCP
+    transports have to be opened and closed by the same task.
+    """
+    def __init__(self, connections, call_timeout=120, stop_timeout=5, schema_cache_dir=None):
+        self.connections = connections
+        self.schema_cache_dir = schema_cache_dir
+        if schema_cache_dir:
+            os.makedirs(schema_cache_dir, exist_ok=True)
+        self.refresh_task = None
+        self.call_timeout = call_timeout
+        self.stop_timeout = stop_timeout
+        self.sessions = {} # server name -> ClientSession
+        self.runners = {} # server name -> (task owning the session, event that tells it to stop)
+        self.locks = {name: asyncio.Lock() for name in connections}
+        self.restarts = 0
+
+    async def _run(self, name, ready, stop):
+        """Open the session, hand it over through ready, and keep it open until stop is set or the server dies."""
+        session = None
+        try:
+            async with create_session(self.connections[name]) as session:
+                await session.initialize()
+                self.sessions[name] = session
+                ready.set_result(session)
+                await stop.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(f"=== MCP server {name} went away: {e!r} ===")
+        finally:
+            if self.sessions.get(name) is session:
+                del self.sessions[name]
+
+    async def session(self, name):
+        """The open session for this server, starting the server if it isn't running."""
+        async with self.locks[name]:
+            runner = self.runners.get(name)
+            if name in self.sessions and runner and not runner[0].done():
+                return self.sessions[name]
+            if runner:
+                await self._stop(name)
+            start = time.perf_counter()
+            ready = asyncio.get_running_loop().create_future()
+            stop = asyncio.Event()
+            self.runners[name] = (asyncio.create_task(self._run(name, ready, stop)), stop)
+            session = await ready
+            print(f"=== Started MCP server {name} in {time.perf_counter() - start:.2f}s ===")
+            return session
+
+    async def _stop(self, name):
+        runner = self.runners.pop(name, None)
+        self.sessions.pop(name, None)
+        if runner is None:
+            return
+        task, stop = runner
+        stop.set()
+        try:
+            await asyncio.wait_for(task, self.stop_timeout) # wait_for cancels the task if it doesn't finish
+        except asyncio.TimeoutError:
+            print(f"=== MCP server {name} didn't stop in {self.stop_timeout}s, cancelled it ===")
+
+    async def restart(self, name):
+        async with self.locks[name]:
+            await self._stop(name)
+        self.restarts += 1
+        return await self.session(name)
+
+    async def start(self):
+        """Start every configured server now instead of on first use."""
+        await asyncio.gather(*(self.session(name) for name in self.connections))
+
+    async def close(self):
+        """Shut down every server, e.g. from an on_app_shutdown hook."""
+        if self.refresh_task and not self.refresh_task.done():
+            self.refresh_task.cancel()
+            await asyncio.gather(self.refresh_task, return_exceptions=True)
+        await asyncio.gather(*(self._stop(name) for name in list(self.runners)))
+        self.locks = {name: asyncio.Lock() for name in self.connections} # so the pool can be used again from another event loop
+
+    async def call_tool(self, server, tool_name, arguments):
+        """Call a tool, restarting the server if the session turns out to be dead.
+        The call is only retried if the session was dead before the request went out; a server that dies while
+        handling it may already have run it (and stateful servers like sequential-thinking would apply it twice),
+        so that's reported as an error instead."""
+        for attempt in range(2):
+            session = await self.session(server)
+            try:
+                return await asyncio.wait_for(session.call_tool(tool_name, arguments), self.call_timeout)
+            except asyncio.TimeoutError:
+                await self.restart(server) # a hung server won't get better; don't retry, the call itself may be the problem
+                raise ToolException(f"{tool_name} on MCP server {server} timed out after {self.call_timeout}s")
+            except (McpError, *_connection_errors) as e:
+                if isinstance(e, McpError) and e.error.code != CONNECTION_CLOSED:
+                    raise ToolException(str(e)) # a protocol-level error from a healthy server
+                if attempt:
+                    raise ToolException(f"MCP server {server} is not responding: {e!r}")
+                print(f"=== MCP server {server} failed during {tool_name} ({e!r}), restarting ===")
+                await self.restart(server)
+                if not isinstance(e, _send_errors):
+                    raise ToolException(
+                        f"MCP server {server} went away while running {tool_name}, so it may or may not have run. "
+                        "The server was restarted; check its state before calling it again."
+                    )
+
+    async def list_tools(self, servers=None):
+        """Tool specs from the servers (all of them by default): dicts with server, name, description, input_schema."""
+        specs = []
+        for server in servers or self.connections:
+            session = await self.session(server)
+            cursor = None
+            while True:
+                page = await session.list_tools(cursor=cursor) if cursor else await session.list_tools()
+                specs.extend(
+                    {"server": server, "name": t.name, "description": t.description or "", "input_schema": t.inputSchema}
+                    for t in page.tools
+                )
+                cursor = page.nextCursor
+                if not cursor:
+                    break
+        return specs
+
+    def make_tool(self, spec):
+        """A LangChain tool that runs on this pool's session for spec["server"]."""
+        async def call(**arguments):
+            result = await self.call_tool(spec["server"], spec["name"], arguments)
+            text = "\n".join(block.text if block.type == "text" else str(block) for block in result.content)
+            if result.isError:
+                raise ToolException(text)
+            return text
+        return StructuredTool(
+            name=spec["name"],
+            description=spec["description"],
+            args_schema=spec["input_schema"],
+            coroutine=call,
+            handle_tool_error=True, # tool errors go back to the model instead of ending the run
+        )
+
+    async def get_tools(self, servers=None):
+        return [self.make_tool(spec) for spec in await self.list_tools(servers)]
+
+    def _cache_path(self, server):
+        """Schemas are cached per server under a hash of its config, so changing the config means rediscovering."""
+        config = json.dumps(self.connections[server], sort_keys=True, default=str)
+        digest = hashlib.sha256(config.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.schema_cache_dir, f"{server}-{digest}.json")
+
+    def cached_specs(self):
+        """Tool specs saved by the last discovery, or None if any server has none (or there's no cache)."""
+        if not self.schema_cache_dir:
+            return None
+        specs = []
+        for server in self.connections:
+            try:
+                with open(self._cache_path(server), "r") as f:
+                    specs.extend(json.load(f))
+            except (OSError, ValueError):
+                return None
+        return specs
+
+    async def refresh_specs(self):
+        """List the tools from every server and save them to the cache."""
+        specs = await self.list_tools()
+        if self.schema_cache_dir:
+            for server in self.connections:
+                path = self._cache_path(server)
+                with open(path + ".tmp", "w") as f:
+                    json.dump([spec for spec in specs if spec["server"] == server], f, indent=2)
+                os.replace(path + ".tmp", path)
+        return specs
+
+    async def load_tools(self, on_change=None):
+        """Tools for every server, from the schema cache when it's warm (re-listing them in the background
+        and calling on_change with new tools if they changed), otherwise by starting the servers and asking them."""
+        start = time.perf_counter()
+        cached = self.cached_specs()
+        if cached is None:
+            specs = await self.refresh_specs()
+            print(f"=== Discovered {len(specs)} MCP tools in {time.perf_counter() - start:.2f}s ===")
+            return [self.make_tool(spec) for spec in specs]
+
+        async def refresh():
+            try:
+                specs = await self.refresh_specs()
+            except Exception as e:
+                print(f"=== Couldn't refresh MCP tool schemas, keeping the cached ones: {e!r} ===")
+                return
+            if specs != cached:
+                print("=== MCP tool schemas changed ===")
+                if on_change:
+                    on_change([self.make_tool(spec) for spec in specs])
+        self.refresh_task = asyncio.create_task(refresh()) # this also warms up the sessions for the first call
+        print(f"=== Loaded {len(cached)} MCP tools from the schema cache in {time.perf_counter() - start:.3f}s ===")
+        return [self.make_tool(spec) for spec in cached]
+
+
+def stub_connections(startup_delay=None):
+    """Connection config for stub_mcp_server.py, for trying the pool out locally."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_mcp_server.py")
+    connection = {"command": sys.executable, "args": [script], "transport": "stdio"}
+    if startup_delay:
+        connection["env"] = dict(os.environ, STUB_MCP_STARTUP_DELAY=str(startup_delay))
+    return {"stub": connection}
+
+
+async def benchmark_pool(n_calls=20):
+    """Compare per-call latency of a fresh session per call (what the adapter tools do) with the pool."""
+    from langchain_mcp_adapters.client import MultiServerMCPClient
+    connections = stub_connections()
+
+    adapter_tools = {tool.name: tool for tool in await MultiServerMCPClient(connections).get_tools()}
+    start = time.perf_counter()
+    for i in range(n_calls):
+        await adapter_tools["echo"].ainvoke({"text": str(i)})
+    per_session = (time.perf_counter() - start) / n_calls * 1000
+
+    pool = MCPSessionPool(connections)
+    tools = {tool.name: tool for tool in await pool.get_tools()}
+    start = time.perf_counter()
+    for i in range(n_calls):
+        await tools["echo"].ainvoke({"text": str(i)})
+    pooled = (time.perf_counter() - start) / n_calls * 1000
+    start = time.perf_counter()
+    await asyncio.gather(*(tools["wait"].ainvoke({"seconds": 0.2}) for _ in range(10)))
+    concurrent = time.perf_counter() - start
+
+    before = await tools["pid"].ainvoke({})
+    await tools["crash"].ainvoke({})
+    after = await tools["pid"].ainvoke({})
+    await pool.close()
+
+    print(f"session per call: {per_session:.1f} ms/call")
+    print(f"pooled session:   {pooled:.1f} ms/call")
+    print(f"10 concurrent 0.2s calls over one session: {concurrent:.2f}s")
+    print(f"restart after crash: pid {before} -> {after} ({pool.restarts} restarts)")
+
+
+if __name__ == "__main__":
+    asyncio.run(benchmark_pool())
@@ -2,11 +2,21 @@
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 from pydantic import BaseModel, Field
 from enum import Enum
+import os
 import json
+import asyncio
 import uuid
-from langchain_openai import OpenAIEmbeddings
-from langchain_core.vectorstores import InMemoryVectorStore
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
 from langchain.schema import Document
+from tools import count_tokens, get_embeddings
+from vector_tools import make_index
 
 _default_stateless_prompt = """
 Progressively summarize the lines of conversation provided.
@@ -57,26 +67,71 @@ class ChatHistorySummarizer:
     default_stateless_prompt = _default_stateless_prompt
     default_cumulative_prompt = _default_cumulative_prompt
 
-    def __init__(self, llm, cumulative=True, cumulative_prompt=None, stateless_prompt=None):
+    def __init__(self, llm, cumulative=True, cumulative_prompt=None, stateless_prompt=None, current_summary="", summarized_count=0):
         self.llm = llm
-        self.current_summary = ""
+        self.current_summary = current_summary
         self.cumulative_prompt = cumulative_prompt or self.__class__.default_cumulative_prompt # is this how you do this?
         self.stateless_prompt = stateless_prompt or self.__class__.default_stateless_prompt
         self.cumulative = cumulative
+        self.summarized_count = summarized_count # watermark: how many messages from the start of the history are already in current_summary
+
+    def reset(self):
+        self.current_summary = ""
+        self.summarized_count = 0
+
+    def _prompt(self, messages, cumulative):
+        if cumulative:
+            return self.cumulative_prompt.format(summary=self.current_summary, new_lines="\n".join([msg.content for msg in messages]))
+        return self.stateless_prompt.format(new_lines="\n".join([msg.content for msg in messages]))
 
     def summarize(self, messages, cumulative=None):
         if not messages:
             return None
         if cumulative is None:
             cumulative = self.cumulative
+        summary = self.llm.invoke(self._prompt(messages, cumulative)).content.strip()
         if cumulative:
-            prompt = self.cumulative_prompt.format(summary=self.current_summary, new_lines="\n".join([msg.content for msg in messages]))
-        else:
-            prompt = self.stateless_prompt.format(new_lines="\n".join([msg.content for msg in messages]))
-        summary = self.llm.invoke(prompt).content.strip()
+            self.current_summary = summary
+        return summary
+
+    async def asummarize(self, messages, cumulative=None):
+        if not messages:
+            return None
+        if cumulative is None:
+            cumulative = self.cumulative
+        summary = (await self.llm.ainvoke(self._prompt(messages, cumulative))).content.strip()
         if cumulative:
             self.current_summary = summary
         return summary
+
+    def _evicted(self, history, keep_n, min_tokens):
+        """The messages that have fallen out of the last keep_n but aren't in the summary yet,
+        or [] if there aren't enough of them (by min_tokens) to be worth summarizing yet."""
+        if len(history) < self.summarized_count:
+            self.reset() # the history was cleared or replaced under us
+        evicted = history[self.summarized_count:max(self.summarized_count, len(history) - keep_n)]
+        if min_tokens and sum(count_tokens(msg.content) for msg in evicted) < min_tokens:
+            return []
+        return evicted
+
+    def summarize_history(self, history, keep_n=5, min_tokens=0):
+        """Fold only the newly evicted messages into the cumulative summary, instead of re-summarizing the whole tail.
+
+        With min_tokens, summarizing waits until the evicted backlog is at least that many tokens.
+        Returns (summary, messages not covered by the summary), which together stand in for the whole history.
+        """
+        evicted = self._evicted(history, keep_n, min_tokens)
+        if evicted:
+            self.summarize(evicted, cumulative=True)
+            self.summarized_count += len(evicted)
+        return self.current_summary, history[self.summarized_count:]
+
+    async def asummarize_history(self, history, keep_n=5, min_tokens=0):
+        evicted = self._evicted(history, keep_n, min_tokens)
+        if evicted:
+            await self.asummarize(evicted, cumulative=True)
+            self.summarized_count += len(evicted)
+        return self.current_summary, history[self.summarized_count:]
     
 
 class OperationType(Enum):
@@ -90,6 +145,7 @@ class MemoryItem(BaseModel):
     """A model to represent a memory item."""
     id: str = Field(..., description="The ID of the memory item to operate on.")
     text: str = Field(..., description="The text parameter for the memory operation.")
+    score: float | None = Field(default=None, exclude=True, description="Similarity to the query it was found by, if any.")
 
 class MemoryEvent(BaseModel):
     """A model to represent a memory operation."""
@@ -141,37 +197,380 @@ Operations:
 
 """
 
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings model with a cache keyed by (model, sha256(text)), so the same string is only ever embedded once.
+
+    There's an in-process LRU tier, and optionally an SQLite file tier (db_path) that survives restarts
+    and can be shared between workers. The file tier evicts least-recently-used rows past max_db_bytes.
+    """
+    def __init__(self, embeddings, model, max_items=10_000, db_path=None, max_db_bytes=256 * 1024 * 1024):
+        self.embeddings = embeddings
+        self.model = model
+        self.max_items = max_items
+        self.max_db_bytes = max_db_bytes
+        self.memory_cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT, hash TEXT, vector BLOB, last_used REAL, PRIMARY KEY (model, hash))"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self.db.commit()
+            self.db_bytes = self.db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    def _key(self, text):
+        return (self.model, hashlib.sha256(text.encode("utf-8")).hexdigest())
+
+    def _lookup(self, key):
+        with self.lock:
+            if key in self.memory_cache:
+                self.memory_cache.move_to_end(key)
+                self.hits += 1
+                return self.memory_cache[key]
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT vector FROM embeddings WHERE model = ? AND hash = ?", key).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?", (time.time(),) + key)
+            self.db.commit()
+            self.hits += 1
+            self.disk_hits += 1
+            vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+            self._remember(key, vector)
+            return vector
+
+    def _remember(self, key, vector):
+        self.memory_cache[key] = vector
+        self.memory_cache.move_to_end(key)
+        while len(self.memory_cache) > self.max_items:
+            self.memory_cache.popitem(last=False)
+
+    def _store(self, keys, vectors):
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self.db is None:
+                return
+            now = time.time()
+            rows = [key + (np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in zip(keys, vectors)]
+            self.db.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)", rows)
+            self.db_bytes += sum(len(row[2]) for row in rows)
+            if self.db_bytes > self.max_db_bytes:
+                # evict the least recently used quarter of the rows, then recount
+                count = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                self.db.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (max(1, count // 4),),
+                )
+                self.db_bytes = self.db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+            self.db.commit()
+
+    def _lookup_all(self, texts):
+        """Cached vectors for texts (None where missing), plus key -> (text, positions) for the ones to embed."""
+        results = [None] * len(texts)
+        missing = {} # duplicates within one call are only embedded once
+        for i, text in enumerate(texts):
+            key = self._key(text)
+            vector = self._lookup(key)
+            if vector is None:
+                missing.setdefault(key, (text, []))[1].append(i)
+            else:
+                results[i] = vector
+        return results, missing
+
+    def _fill(self, results, missing, vectors):
+        keys = list(missing)
+        self.misses += len(keys)
+        self._store(keys, vectors)
+        for key, vector in zip(keys, vectors):
+            for i in missing[key][1]:
+                results[i] = vector
+        return results
+
+    def embed_documents(self, texts):
+        results, missing = self._lookup_all(texts)
+        if not missing:
+            return results
+        vectors = self.embeddings.embed_documents([text for text, _ in missing.values()])
+        return self._fill(results, missing, vectors)
+
+    async def aembed_documents(self, texts):
+        if self.db is None:
+            results, missing = self._lookup_all(texts)
+        else:
+            results, missing = await asyncio.to_thread(self._lookup_all, texts)
+        if not missing:
+            return results
+        vectors = await self.embeddings.aembed_documents([text for text, _ in missing.values()])
+        if self.db is None:
+            return self._fill(results, missing, vectors)
+        return await asyncio.to_thread(self._fill, results, missing, vectors)
+
+    def embed_query(self, text):
+        # OpenAI embeds queries and documents the same way, so they can share cache entries
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self):
+        """Hit/miss counters, to see how many embedding calls the cache is saving."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "memory_items": len(self.memory_cache),
+        }
+
+
+class MatrixVectorStore(VectorStore):
+    """Drop-in replacement for InMemoryVectorStore that keeps the vectors in a vector_tools index
+    (by default FlatIndex: one contiguous, pre-normalised float32 matrix) instead of a Python list per document."""
+    def __init__(self, embedding, index="flat"):
+        self.embedding = embedding
+        self.index = make_index(index or "flat") if isinstance(index, (str, type(None))) else index
+        self.docs = {} # id -> (text, metadata)
+        self.lock = threading.RLock() # memory writes can run in a background thread while the reply path searches
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.docs
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, **kwargs):
+        store = cls(embedding=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def add_vectors(self, ids, texts, vectors, metadatas=None):
+        """Add (or overwrite) documents whose vectors have already been computed."""
+        metadatas = metadatas or [{} for _ in ids]
+        with self.lock:
+            for doc_id, text, metadata in zip(ids, texts, metadatas):
+                self.docs[doc_id] = (text, metadata)
+            self.index.add(ids, vectors)
+        return list(ids)
+
+    def load_vectors(self, ids, texts, matrix):
+        """Like add_vectors, but for a saved, already-normalised matrix, which the flat index uses without copying."""
+        with self.lock:
+            for doc_id, text in zip(ids, texts):
+                self.docs[doc_id] = (text, {})
+            self.index.load_matrix(ids, matrix)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        return self.add_vectors(ids, texts, self.embedding.embed_documents(texts), metadatas)
+
+    async def aadd_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        return self.add_vectors(ids, texts, await self.embedding.aembed_documents(texts), metadatas)
+
+    def add_documents(self, documents, ids=None, **kwargs):
+        ids = ids or [doc.id or str(uuid.uuid4()) for doc in documents]
+        return self.add_texts([doc.page_content for doc in documents], [doc.metadata for doc in documents], ids)
+
+    async def aadd_documents(self, documents, ids=None, **kwargs):
+        ids = ids or [doc.id or str(uuid.uuid4()) for doc in documents]
+        return await self.aadd_texts([doc.page_content for doc in documents], [doc.metadata for doc in documents], ids)
+
+    def delete(self, ids=None, **kwargs):
+        with self.lock:
+            ids = [doc_id for doc_id in ids or [] if doc_id in self.docs]
+            for doc_id in ids:
+                del self.docs[doc_id]
+            self.index.delete(ids)
+
+    def clear(self):
+        with self.lock:
+            self.docs.clear()
+            self.index.clear()
+
+    def get_by_ids(self, ids):
+        with self.lock:
+            return [self._document(doc_id) for doc_id in ids if doc_id in self.docs]
+
+    def items(self):
+        """All ids and texts, plus their vectors as one matrix (for saving)."""
+        with self.lock:
+            ids = list(self.docs)
+            texts = [self.docs[doc_id][0] for doc_id in ids]
+            return ids, texts, self.index.get_vectors(ids) if ids else None
+
+    def _document(self, doc_id):
+        text, metadata = self.docs[doc_id]
+        return Document(id=doc_id, page_content=text, metadata=metadata)
+
+    def similarity_search_by_vectors(self, embeddings, k=4):
+        """Batched multi-query search: one list of (Document, score) pairs per query vector."""
+        with self.lock:
+            return [
+                [(self._document(doc_id), score) for doc_id, score in hits]
+                for hits in self.index.search_batch(embeddings, k)
+            ]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        return self.similarity_search_by_vectors([embedding], k)[0]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    async def asimilarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(await self.embedding.aembed_query(query), k)
+
+    async def asimilarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in await self.asimilarity_search_with_score(query, k)]
+
+
+def _vector_file_paths(file_path):
+    """Where the vectors (and the model they came from) are stored for a memory file."""
+    return file_path + ".vectors.npy", file_path + ".vectors.json"
+
 class InMemoryOpenAIMemory:
-    def __init__(self, api_key=None, model="text-embedding-3-small", file_path=None):
-        self.embeddings = OpenAIEmbeddings(
-            api_key=api_key,
-            model=model
+    """Memories in a MatrixVectorStore. Methods that may embed text have a-prefixed async versions."""
+    max_embedding_tokens = 8191 # per-input limit for the OpenAI embedding models
+
+    def __init__(self, api_key=None, model="text-embedding-3-small", file_path=None, cache_path=None, index="flat", embeddings=None):
+        """index picks the search backend: "flat" (exact), "hnsw" (approximate, see vector_tools),
+        or an index object with the same methods. Pass embeddings to share one CachedEmbeddings between memories."""
+        self.model = model
+        # every query, update and reload goes through the cache, so repeated text is only embedded once
+        self.embeddings = embeddings or CachedEmbeddings(
+            get_embeddings(model=model, api_key=api_key),
+            model=model,
+            db_path=cache_path,
         )
-        self.store = InMemoryVectorStore(embedding=self.embeddings)
+        self.model = getattr(self.embeddings, "model", model)
+        self.store = MatrixVectorStore(embedding=self.embeddings, index=index)
         if file_path:
             self.load_from_file(file_path)
 
+    def __contains__(self, memory_id):
+        return memory_id in self.store
 
     def clear_memories(self):
         """Clear all memories."""
         self.store.clear()
         
-    def load_from_file(self, file_path):
-        """Load memories from a JSON file."""
+    def load_from_file(self, file_path, batch_size=500, max_batch_tokens=100_000):
+        """Load memories from a JSON file, embedding them one batch at a time instead of one request per memory.
+
+        If save_to_file left a vector file next to it (made with the same embedding model), the vectors are
+        memory-mapped from there instead and nothing is re-embedded.
+        A batch is sent when it reaches batch_size records or max_batch_tokens tokens, whichever comes first.
+        Returns a dict with the number of memories loaded, skipped and failed.
+        """
         with open(file_path, 'r') as f:
             data = json.load(f)
-            for item in data:
-                memory_id = item['id']
-                text = item['text']
-                doc = Document(id=memory_id, page_content=text)
-                self.store.add_documents([doc])
-
-    def save_to_file(self, file_path):
-        """Save memories to a JSON file."""
-        documents = self.store.get_all_documents()
-        data = [{'id': doc.id, 'text': doc.page_content} for doc in documents]
+        vectors = self._load_vectors(file_path, len(data))
+        stats = {"loaded": 0, "skipped": 0, "failed": 0}
+        seen_ids = set()
+        mapped_rows, mapped_ids, mapped_texts = [], [], []
+        batch, batch_tokens = [], 0
+        for i, item in enumerate(data):
+            if not isinstance(item, dict) or not item.get('id') or not item.get('text') or item['id'] in seen_ids:
+                stats["skipped"] += 1
+                continue
+            memory_id = item['id']
+            text = item['text']
+            seen_ids.add(memory_id)
+            if vectors is not None:
+                mapped_rows.append(i)
+                mapped_ids.append(memory_id)
+                mapped_texts.append(text)
+                continue
+            tokens = count_tokens(text, self.model)
+            if tokens > self.max_embedding_tokens:
+                print(f"Skipping memory {memory_id}: {tokens} tokens is too long to embed")
+                stats["skipped"] += 1
+                continue
+            if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_batch_tokens):
+                self._add_batch(batch, stats)
+                batch, batch_tokens = [], 0
+            batch.append(Document(id=memory_id, page_content=text))
+            batch_tokens += tokens
+        if batch:
+            self._add_batch(batch, stats)
+        if mapped_ids:
+            # when every row is used (the usual case) the memory map itself becomes the index matrix,
+            # so processes loading the same file share one copy until they modify it
+            if len(mapped_rows) < len(vectors):
+                vectors = vectors[mapped_rows]
+            self.store.load_vectors(mapped_ids, mapped_texts, vectors)
+            stats["loaded"] += len(mapped_ids)
+        print(f"Loaded {stats['loaded']} memories from {file_path} ({stats['skipped']} skipped, {stats['failed']} failed)")
+        return stats
+
+    def _add_batch(self, docs, stats):
+        # add_documents makes a single embed_documents call for the whole batch
+        try:
+            self.store.add_documents(docs)
+            stats["loaded"] += len(docs)
+        except Exception as e:
+            print(f"Failed to embed a batch of {len(docs)} memories: {e}")
+            stats["failed"] += len(docs)
+
+    def _load_vectors(self, file_path, count):
+        """Memory-map the saved vectors for file_path, or return None if they're missing or don't match."""
+        vectors_path, meta_path = _vector_file_paths(file_path)
+        if not (os.path.exists(vectors_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get("model") != self.model:
+            print(f"Saved vectors were made with {meta.get('model')}, not {self.model}; re-embedding.")
+            return None
+        vectors = np.load(vectors_path, mmap_mode='r')
+        if vectors.shape[0] != count or meta.get("count") != count:
+            print(f"Saved vectors don't line up with {file_path}; re-embedding.")
+            return None
+        return vectors
+
+    def save_to_file(self, file_path, save_vectors=True):
+        """Save memories to a JSON file, plus (by default) their vectors as a .npy matrix so they don't need re-embedding."""
+        ids, texts, matrix = self.store.items()
+        data = [{'id': memory_id, 'text': text} for memory_id, text in zip(ids, texts)]
         with open(file_path, 'w') as f:
-            json.dump(data, f, indent=2)
+            json.dump(data, f, separators=(',', ':'))
+        vectors_path, meta_path = _vector_file_paths(file_path)
+        if not save_vectors:
+            # don't leave old vectors around that no longer match the text
+            for path in (vectors_path, meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        if matrix is None:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        # write to a temp file and rename, so a process that has the old file mapped keeps a consistent view
+        with open(vectors_path + ".tmp", 'wb') as f:
+            np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+        os.replace(vectors_path + ".tmp", vectors_path)
+        with open(meta_path, 'w') as f:
+            json.dump({"model": self.model, "dim": int(matrix.shape[1]), "count": len(ids)}, f)
 
     def add_memory(self, text):
         """Add a new memory item."""
@@ -179,12 +578,20 @@ class InMemoryOpenAIMemory:
         doc = Document(id=memory_id, page_content=text)
         self.store.add_documents([doc])
         return memory_id
+
+    async def aadd_memory(self, text):
+        memory_id = str(uuid.uuid4())
+        await self.store.aadd_documents([Document(id=memory_id, page_content=text)])
+        return memory_id
     
     def update_memory(self, memory_id, text):
         """Update an existing memory item."""
         doc = Document(id=memory_id, page_content=text)
         self.store.add_documents([doc]) # Overwrites the existing memory with the same ID
 
+    async def aupdate_memory(self, memory_id, text):
+        await self.store.aadd_documents([Document(id=memory_id, page_content=text)])
+
     def delete_memory(self, memory_id):
         """Delete a memory item."""
         self.store.delete(ids=[memory_id])
@@ -196,19 +603,42 @@ class InMemoryOpenAIMemory:
 
     def find_memories(self, query, n=5):
         """Find memories that match a query."""
-        results = self.store.similarity_search(query, k=n)
-        memory_items = [MemoryItem(id=result.id, text=result.page_content) for result in results]
+        results = self.store.similarity_search_with_score(query, k=n)
+        memory_items = [MemoryItem(id=result.id, text=result.page_content, score=score) for result, score in results]
         return memory_items
 
+    async def afind_memories(self, query, n=5):
+        results = await self.store.asimilarity_search_with_score(query, k=n)
+        return [MemoryItem(id=result.id, text=result.page_content, score=score) for result, score in results]
+
+    def _search_batch(self, vectors, n):
+        return [
+            [MemoryItem(id=result.id, text=result.page_content, score=score) for result, score in results]
+            for results in self.store.similarity_search_by_vectors(vectors, k=n)
+        ]
+
+    def find_memories_batch(self, queries, n=5):
+        """Find memories for several queries at once: one embedding request and one batched search.
+        Returns a list of results per query."""
+        if not queries:
+            return []
+        return self._search_batch(self.embeddings.embed_documents(list(queries)), n)
+
+    async def afind_memories_batch(self, queries, n=5):
+        if not queries:
+            return []
+        return self._search_batch(await self.embeddings.aembed_documents(list(queries)), n)
+
         
 class Mem0izer:
-    """A class to handle the Mem0 operations for the Chainlit app."""
+    """A class to handle the Mem0 operations for the Chainlit app.
+    Every step has an a-prefixed async twin built on ainvoke/aembed_documents, for use from Chainlit handlers."""
     def __init__(self, llm, memory=None, api_key=None):
         self.fact_extractor = llm.with_structured_output(ExtractedFacts, method="json_schema")
         self.update_preparer = llm.with_structured_output(MemoryEventsList, method="json_schema")
         self.memory = memory or InMemoryOpenAIMemory(api_key=api_key)
 
-    def extract_facts(self, messages):
+    def _extract_facts_prompt(self, messages):
         messages_text = ""
         print(messages)
         for message in messages:
@@ -223,35 +653,66 @@ class Mem0izer:
         # I did it this way because str.format() seems to have trouble when there are { and } in the actual text
         formatted = _extract_facts_prompt_template.replace("{input}", messages_text)
         print(f"Extracting facts from: {formatted}")
-        response = self.fact_extractor.invoke(formatted)
+        return formatted
+
+    def extract_facts(self, messages):
+        response = self.fact_extractor.invoke(self._extract_facts_prompt(messages))
         print(f"Response was: {response}")
         return response.facts
 
-    def retrieve_memories(self, messages_or_facts):
-        if not messages_or_facts:
-            return []
+    async def aextract_facts(self, messages):
+        response = await self.fact_extractor.ainvoke(self._extract_facts_prompt(messages))
+        print(f"Response was: {response}")
+        return response.facts
+
+    @staticmethod
+    def _queries(messages_or_facts):
         if isinstance(messages_or_facts, str):
             messages_or_facts = [messages_or_facts]
-        all_memories = {}
+        queries = []
         for item in messages_or_facts:
             if isinstance(item, str):
-                memories = self.memory.find_memories(item)
+                queries.append(item)
             elif isinstance(item, HumanMessage) or isinstance(item, AIMessage):
-                memories = self.memory.find_memories(item.content)
+                queries.append(item.content)
+        return queries
+
+    @staticmethod
+    def _merge_memories(results):
+        all_memories = {}
+        for memories in results:
             for memory in memories:
-                if memory.id not in all_memories:
+                # the same memory can match several facts; keep the best score it got
+                if memory.id not in all_memories or memory.score > all_memories[memory.id].score:
                     all_memories[memory.id] = memory
-        all_memories = list(all_memories.values())
+        all_memories = sorted(all_memories.values(), key=lambda memory: memory.score, reverse=True)
         return all_memories
 
-    def prepare_updates(self, facts, memories):
+    def retrieve_memories(self, messages_or_facts, n=5):
+        """Find memories for all the facts/messages in one batch, merged by id (best score first)."""
+        if not messages_or_facts:
+            return []
+        return self._merge_memories(self.memory.find_memories_batch(self._queries(messages_or_facts), n))
+
+    async def aretrieve_memories(self, messages_or_facts, n=5):
+        if not messages_or_facts:
+            return []
+        return self._merge_memories(await self.memory.afind_memories_batch(self._queries(messages_or_facts), n))
+
+    def _prepare_updates_prompt(self, facts, memories):
         facts_text = "\n".join(facts)
         memories_text = str([
             memory.model_dump_json(indent=2) for memory in memories
         ])
         # I did it this way because str.format() seems to have trouble when there are { and } in the actual text
-        formatted = _prepare_updates_prompt_template.replace("{memories}", memories_text).replace("{facts}", facts_text)
-        updates = self.update_preparer.invoke(formatted)
+        return _prepare_updates_prompt_template.replace("{memories}", memories_text).replace("{facts}", facts_text)
+
+    def prepare_updates(self, facts, memories):
+        updates = self.update_preparer.invoke(self._prepare_updates_prompt(facts, memories))
+        return updates.events
+
+    async def aprepare_updates(self, facts, memories):
+        updates = await self.update_preparer.ainvoke(self._prepare_updates_prompt(facts, memories))
         return updates.events
 
     def handle_updates(self, updates):
@@ -269,19 +730,59 @@ class Mem0izer:
             else:
                 raise ValueError(f"Unknown operation type: {update.event}")
 
-    def apply_mem0_operations(self, message):
+    async def ahandle_updates(self, updates):
+        for update in updates:
+            if update.event == OperationType.ADD:
+                await self.memory.aadd_memory(update.text)
+            elif update.event == OperationType.UPDATE:
+                if update.id in self.memory:
+                    await self.memory.aupdate_memory(update.id, update.text)
+            elif update.event == OperationType.DELETE:
+                if update.id in self.memory:
+                    self.memory.delete_memory(update.id) # no network call, nothing to await
+            elif update.event == OperationType.NONE:
+                pass
+            else:
+                raise ValueError(f"Unknown operation type: {update.event}")
+
+    def read_memories(self, message, n=5):
+        """The fast path: memories relevant to a message, for the prompt. No LLM calls, at most one embedding request."""
+        memories = self.retrieve_memories([message], n)
+        print(f"Memories read for message: {memories}")
+        return memories
+
+    async def aread_memories(self, message, n=5):
+        memories = await self.aretrieve_memories([message], n)
+        print(f"Memories read for message: {memories}")
+        return memories
+
+    def write_memories(self, message):
+        """The slow path: extract facts from a message and add/update/delete memories to match.
+        Returns the extracted facts. Meant to run in the background, e.g. through a MemoryWriteQueue."""
         facts = self.extract_facts([message])
         print(f"Extracted facts: {facts}")
-        all_facts = {}
-        for fact in facts: # This logic is slightly different from what Mem0 does in their repo, but we can deal with that later.
-            top_facts = self.retrieve_memories([fact])
-            for top_fact in top_facts:
-                if top_fact.id not in all_facts:
-                    all_facts[top_fact.id] = top_fact
-        all_facts = list(all_facts.values())
+        if not facts:
+            return []
+        # This logic is slightly different from what Mem0 does in their repo, but we can deal with that later.
+        all_facts = self.retrieve_memories(facts)
         updates = self.prepare_updates(facts, all_facts)
         print(f"Updates prepared: {updates}")
         self.handle_updates(updates)
+        return facts
+
+    async def awrite_memories(self, message):
+        facts = await self.aextract_facts([message])
+        print(f"Extracted facts: {facts}")
+        if not facts:
+            return []
+        all_facts = await self.aretrieve_memories(facts)
+        updates = await self.aprepare_updates(facts, all_facts)
+        print(f"Updates prepared: {updates}")
+        await self.ahandle_updates(updates)
+        return facts
+
+    def apply_mem0_operations(self, message):
+        facts = self.write_memories(message)
         context_memories = self.retrieve_memories(facts)
         if not context_memories:
             print("No context memories found.")
@@ -289,3 +790,60 @@ class Mem0izer:
         else:
             print(f"Context memories found: {context_memories}")
         return context_memories
+
+    async def aapply_mem0_operations(self, message):
+        facts = await self.awrite_memories(message)
+        context_memories = await self.aretrieve_memories(facts)
+        if not context_memories:
+            print("No context memories found.")
+            return []
+        else:
+            print(f"Context memories found: {context_memories}")
+        return context_memories
+
+
+class MemoryWriteQueue:
+    """Runs memory writes as background asyncio tasks so they stay off the response path.
+
+    Jobs submitted under the same key (e.g. a user or session) run in the order they were submitted;
+    jobs for different keys run concurrently, at most max_concurrency at a time.
+    Call flush() to wait for outstanding writes, e.g. at the end of a chat or on shutdown.
+    """
+    def __init__(self, max_concurrency=4):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.last_task = {} # key -> most recent task for that key
+        self.tasks = set()
+
+    def submit(self, key, func, *args):
+        """Queue func(*args) to run after earlier jobs for the same key. func can be sync (run in a thread) or async."""
+        task = asyncio.create_task(self._run(self.last_task.get(key), func, args))
+        self.last_task[key] = task
+        self.tasks.add(task)
+        task.add_done_callback(lambda task: self._done(key, task))
+        return task
+
+    def _done(self, key, task):
+        self.tasks.discard(task)
+        if self.last_task.get(key) is task:
+            del self.last_task[key]
+
+    async def _run(self, previous, func, args):
+        if previous is not None:
+            await asyncio.wait([previous]) # just for ordering; its errors were already reported
+        async with self.semaphore:
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    await func(*args)
+                else:
+                    await asyncio.to_thread(func, *args)
+            except Exception as e:
+                print(f"Background memory write failed: {e}")
+
+    async def flush(self, key=None):
+        """Wait for the outstanding writes for one key, or for all of them."""
+        if key is None:
+            tasks = list(self.tasks)
+        else:
+            tasks = [self.last_task[key]] if key in self.last_task else []
+        if tasks:
+            await asyncio.wait(tasks)
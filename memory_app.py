@@ -1,13 +1,18 @@
 # The idea here is I'm going to implement something like the Mem0 system
 ## Testing was less than thorough...
+import os
 import json
+import asyncio
+from collections import OrderedDict
 import chainlit as cl
 from langchain_core.tools import tool 
-from tools import create_react_tool_agent
-from chainlit_tools import files_to_messages
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from tools import create_react_tool_agent, get_chat_model, get_embeddings, close_clients
+from chainlit_tools import SessionStore, stream_agent_response
+from attachment_tools import AttachmentStore, ingest_files, referenced_files
+from context_tools import ContextBuilder
+from langchain_core.messages import HumanMessage, AIMessage
 import app_memory_hook
-from mem0_tools import ChatHistorySummarizer, Mem0izer
+from mem0_tools import ChatHistorySummarizer, Mem0izer, MemoryWriteQueue, InMemoryOpenAIMemory, CachedEmbeddings
 from langchain_tools import long_division
 
 with open("config.json", "r") as f:
@@ -16,24 +21,85 @@ with open("config.json", "r") as f:
 model = config["openai"]["default_model"]
 api_key = config["openai"]["api_key"]
 
-chat_history = []
+sessions = SessionStore(**config.get("sessions", {})) # history etc. per chat, instead of one global list
 keep_n_full_messages = 5
+max_context_tokens = config.get("context", {}).get("max_tokens", 100_000)
+summarize_min_tokens = 1000 # let older messages pile up to about this many tokens before summarizing them
 
+# The agent, summarizer and mem0izers all share one client (and its connection pool)
+llm = get_chat_model(model=model, api_key=api_key)
 agent = create_react_tool_agent(
-    model=model,
-    api_key=api_key,
+    llm=llm,
     tools=[long_division],
 )
 # Set up memory system
-llm = agent.agent.runnable.steps[2].bound
-summarizer = ChatHistorySummarizer(llm=llm)
-mem0izer = Mem0izer(llm=llm, api_key=api_key)
+embedding_model = "text-embedding-3-small"
+embeddings = CachedEmbeddings(get_embeddings(model=embedding_model, api_key=api_key), model=embedding_model) # shared by every namespace
+# files are stored once by content hash and shared by all sessions
+attachments = AttachmentStore(embeddings, model=model, store_dir=config.get("attachments", {}).get("store_dir", "attachment_store"))
+context_builder = ContextBuilder(max_tokens=max_context_tokens, model=model, attachment_store=attachments)
+mem0izers = OrderedDict() # memory namespace -> Mem0izer, so users don't see each other's memories; least recently used first
+evicting = {} # namespace -> task writing it to disk, which has to finish before the namespace is loaded again
+loading = {} # namespace -> task reading it back, shared by everyone who asks for it meanwhile
+memory_config = config.get("memory", {})
+max_namespaces = memory_config.get("max_namespaces", 100) # each one holds an index of vectors, so keep only the active ones
+memory_dir = memory_config.get("dir", "memory_spill")
+os.makedirs(memory_dir, exist_ok=True)
+memory_writes = MemoryWriteQueue(max_concurrency=4) # fact extraction and memory updates run after the reply
+
+def _memory_path(namespace):
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in namespace)
+    return os.path.join(memory_dir, f"{safe}.json")
+
+async def _load_mem0izer(namespace):
+    try:
+        memory = InMemoryOpenAIMemory(embeddings=embeddings)
+        if os.path.exists(_memory_path(namespace)):
+            await asyncio.to_thread(memory.load_from_file, _memory_path(namespace))
+        mem0izers[namespace] = Mem0izer(llm=llm, memory=memory)
+    finally:
+        del loading[namespace]
+
+async def get_mem0izer(namespace):
+    """The namespace's Mem0izer, loaded back from memory_dir if it was evicted."""
+    # a loop, since it can be evicted again by the time we get to run
+    while namespace not in mem0izers:
+        if namespace in evicting:
+            await evicting[namespace]
+        elif namespace in loading:
+            # two chats loading the same namespace at once would each get their own copy, and one's writes would be lost
+            await asyncio.shield(loading[namespace])
+        else:
+            loading[namespace] = asyncio.ensure_future(_load_mem0izer(namespace))
+    mem0izers.move_to_end(namespace)
+    while len(mem0izers) > max_namespaces:
+        evict_mem0izer(next(iter(mem0izers)))
+    return mem0izers[namespace]
+
+def evict_mem0izer(namespace):
+    """Drop a namespace from memory once its pending writes are done, saving it (with its vectors) to memory_dir."""
+    mem0izer = mem0izers.pop(namespace, None)
+    if mem0izer is None or namespace in evicting:
+        return
+    async def evict():
+        try:
+            while namespace in memory_writes.last_task: # including writes submitted while we waited
+                await memory_writes.flush(namespace)
+            await asyncio.to_thread(mem0izer.memory.save_to_file, _memory_path(namespace))
+        finally:
+            del evicting[namespace]
+    evicting[namespace] = asyncio.ensure_future(evict())
+
+def current_mem0izer():
+    """The most recently used namespace's Mem0izer (e.g. to poke at from the notebook), or None before any chat used one."""
+    return next(reversed(mem0izers.values()), None)
+
 # attach memory hooks so they can be accessed in the notebook
-app_memory_hook.chat_history = chat_history
+app_memory_hook.sessions = sessions
 app_memory_hook.agent = agent
 app_memory_hook.llm = llm
-app_memory_hook.summarizer = summarizer
-app_memory_hook.mem0izer = mem0izer
+app_memory_hook.mem0izers = mem0izers
+app_memory_hook.current_mem0izer = current_mem0izer
 
 
 
@@ -41,7 +107,10 @@ app_memory_hook.mem0izer = mem0izer
 @cl.on_chat_start
 async def on_chat_start():   
     print("CHAT STARTED")
-    chat_history.clear()  # Clear chat history at the start of each chat  
+    state = sessions.reset()  # Fresh history and summary at the start of each chat
+    user = cl.user_session.get("user")
+    if user:
+        state.memory_namespace = user.identifier # memories follow the user across chats when there's a login
     intro_message = AIMessage(f"Welcome to the Chainlit app! I can perform long division and read file attachments. Try sending me a message or attaching a file.")
     await cl.Message(content=intro_message.content).send()
     
@@ -49,38 +118,43 @@ async def on_chat_start():
 async def on_message(message: cl.Message):
     print(f"=== MESSAGE RECEIVED: {message.content} ===")
     input = message.content
-
+    state = sessions.current()
+    chat_history = state.history
+    mem0izer = await get_mem0izer(state.memory_namespace)
 
     ## Prepare the chat history for the agent
-    file_messages = files_to_messages(message) # Add file attachments to the chat history
-    older_messages, newer_messages = chat_history[:-keep_n_full_messages], chat_history[-keep_n_full_messages:]
-    if len(older_messages) > 0:
-        summary_message = summarizer.summarize(older_messages, cumulative=True)
-        summary_message = SystemMessage(content=summary_message)
-    else:
-        summary_message = None
-
-    if file_messages:
+    # Attachments are stored once by content hash (read off the event loop, chunked and indexed);
+    # the history just gets a small reference to each, which the context builder expands into the relevant chunks
+    file_references = await ingest_files(message, attachments)
+    chat_history.extend(file_references)
+    # Only messages that have dropped out of the recent window since last time get summarized
+    summarizer = ChatHistorySummarizer(llm=llm, current_summary=state.summary, summarized_count=state.summarized_count)
+    summary, newer_messages = await summarizer.asummarize_history(
+        chat_history, keep_n=keep_n_full_messages, min_tokens=summarize_min_tokens
+    )
+    state.summary, state.summarized_count = summarizer.current_summary, summarizer.summarized_count
+
+    if file_references: # new files this turn; memories come from their relevant parts, not every chunk on every turn
+        file_messages = await attachments.arelevant_messages(input, referenced_files(file_references))
         file_message_test = "\n".join(["File Attachments:"]+[msg.content for msg in file_messages])
         current_message_text = f"{file_message_test}\n\n{input}"
-    ## Note that in this setup, we aren't actually adding the files to the chat history...
     else:
         current_message_text = input
 
-    memories = mem0izer.apply_mem0_operations(current_message_text)
-    if memories:
-        memories_message = SystemMessage(content="\n".join([f"{memory.text}" for memory in memories]))
-    else:
-        memories_message = None
-
-    input_chat_history = newer_messages
-    if memories_message:
-        input_chat_history = [memories_message] + input_chat_history
-    if summary_message:
-        input_chat_history = [summary_message] + input_chat_history
-
-    response = await agent.ainvoke({
-        "input": current_message_text,
+    # Only the cheap lookup happens before the reply; extracting facts and updating memories happens in the background
+    memories = await mem0izer.aread_memories(current_message_text)
+    memory_writes.submit(state.memory_namespace, mem0izer.awrite_memories, current_message_text)
+
+    # Attachment chunks go in as their own messages so the budget can truncate them instead of the user's input
+    input_chat_history = await context_builder.abuild(
+        input,
+        history=newer_messages,
+        summary=summary,
+        memories=memories,
+    )
+    # Tokens and tool calls show up in the UI as they happen
+    response = await stream_agent_response(agent, {
+        "input": input,
         "chat_history": input_chat_history
     })
     output = response["output"]
@@ -91,6 +165,22 @@ async def on_message(message: cl.Message):
     chat_history.append(HumanMessage(content=input))
     chat_history.append(AIMessage(content=output))
 
-    print(f"=== SENDING RESPONSE: {output} ===")
-    # Send the response back to the user
-    await cl.Message(content=output).send()
\ No newline at end of file
+    print(f"=== SENT RESPONSE: {output} ===")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    state = sessions.current()
+    await memory_writes.flush(state.memory_namespace)
+    if state.memory_namespace == state.session_id: # nobody else uses a per-chat namespace, so it can go to disk now
+        evict_mem0izer(state.memory_namespace)
+    sessions.drop(state.session_id) # every chat starts over with a fresh state, so don't keep this one (or its spill file)
+
+@cl.on_app_shutdown
+async def on_app_shutdown():
+    print("Flushing background memory writes...")
+    for namespace in list(mem0izers):
+        evict_mem0izer(namespace)
+    await asyncio.gather(*evicting.values(), return_exceptions=True)
+    await memory_writes.flush()
+    await close_clients()
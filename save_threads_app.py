@@ -4,9 +4,13 @@ import json
 from operator import sub
 import chainlit as cl
 from langchain_core.tools import tool 
-from tools import create_react_tool_agent
+from tools import create_react_tool_agent, get_embeddings, close_clients
+from context_tools import ContextBuilder
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-from chainlit_tools import files_to_messages, ChatHistorySaver
+from chainlit_tools import ChatHistorySaver, SessionStore, stream_agent_response
+from mem0_tools import CachedEmbeddings
+from attachment_tools import AttachmentStore, ingest_files
+from thread_tools import Autosaver, AUTOSAVE_PREFIX
 import app_memory_hook # could be folded into chainlit_tools.py
 from langchain_tools import long_division
 
@@ -15,22 +19,33 @@ with open("config.json", "r") as f:
 
 model = config["openai"]["default_model"]
 api_key = config["openai"]["api_key"]
+max_context_tokens = config.get("context", {}).get("max_tokens", 100_000)
 
-chat_history = []
-chat_history_saver = ChatHistorySaver(subdir="saved_threads")
+sessions = SessionStore(**config.get("sessions", {})) # history per chat, instead of one global list
+embedding_model = "text-embedding-3-small"
+embeddings = CachedEmbeddings(get_embeddings(model=embedding_model, api_key=api_key), model=embedding_model)
+# files are stored once by content hash and shared by all sessions; saved threads keep just the references
+attachments = AttachmentStore(embeddings, model=model, store_dir=config.get("attachments", {}).get("store_dir", "attachment_store"))
+context_builder = ContextBuilder(max_tokens=max_context_tokens, model=model, attachment_store=attachments)
+autosave_config = config.get("autosave", {})
+chat_history_saver = ChatHistorySaver(subdir="saved_threads", embeddings=embeddings, # embeddings add meaning-based thread search
+                                      autosave_prefix=autosave_config.get("name_prefix", AUTOSAVE_PREFIX))
+# every chat is also written to the same store in the background, a batch every few seconds, so a crash loses at most one batch
+autosave = Autosaver(chat_history_saver.store, **autosave_config)
 
 agent = create_react_tool_agent(
     model=model,
     api_key=api_key,
     tools=[long_division],
 )
-app_memory_hook.chat_history, app_memory_hook.agent = chat_history, agent
+app_memory_hook.sessions, app_memory_hook.agent = sessions, agent
 
 @cl.on_chat_start
 async def on_chat_start():   
-    chat_history.clear()  # Clear chat history at the start of each chat  
+    sessions.reset()  # Fresh history at the start of each chat
+    chat_history_saver.search.schedule_update() # load the saved search vectors / embed new messages in the background
     intro_message = AIMessage(f"Welcome to the Chainlit app!") # don't save this into chat_history
-    await cl.Message(content=intro_message.content, actions=[chat_history_saver.load_action]).send()
+    await cl.Message(content=intro_message.content, actions=[chat_history_saver.load_action, chat_history_saver.search_action]).send()
 
 # break out the logic below that turns attachments into messages
 
@@ -38,14 +53,18 @@ async def on_chat_start():
 @cl.on_message
 async def on_message(message: cl.Message):
     print(f"=== MESSAGE RECEIVED: {message.content} ===")
-    if message.elements:
-        chat_history.extend(files_to_messages(message))
+    state = sessions.current()
+    chat_history = state.history
+    # a re-uploaded file is recognised by its hash, and either way the history only gets a small reference
+    chat_history.extend(await ingest_files(message, attachments))
     
     input = message.content
-    response = await agent.ainvoke({
+    # Tokens and tool calls show up in the UI as they happen
+    response = await stream_agent_response(agent, {
         "input": input,
-        "chat_history": chat_history,
-    })
+        # the newest messages that fit the budget; a resumed thread's older messages are covered by its stored summary, if any
+        "chat_history": await context_builder.abuild(input, history=chat_history, summary=state.summary or None),
+    }, actions=[chat_history_saver.save_action])
     output = response["output"] # we can look at this more later
     if response["intermediate_steps"]:
         for step in response["intermediate_steps"]:
@@ -54,23 +73,43 @@ async def on_message(message: cl.Message):
     ## Update chat history with the new message and response
     chat_history.append(HumanMessage(content=input))
     chat_history.append(AIMessage(content=output))
+    autosave.mark_dirty(state)
 
-    print(f"=== SENDING RESPONSE: {output} ===")
-    await cl.Message(content=output, actions=[chat_history_saver.save_action]).send()
+    print(f"=== SENT RESPONSE: {output} ===")
 
 
 @cl.action_callback("save_chat_history")
 async def save_chat_history_action():
-    await chat_history_saver.save_chat_history(chat_history)
-    await cl.Message("Chat history saved.").send()
+    state = sessions.current()
+    if await chat_history_saver.save_chat_history(state):
+        await autosave.forget(state) # it's in the named thread now, so its "autosave <session id>" thread can go
+        await cl.Message("Chat history saved.").send()
 
 @cl.action_callback("load_chat_history")
 async def load_chat_history_action():
-    loaded_history = await chat_history_saver.load_chat_history()
-    if loaded_history:
-        chat_history.clear()
-        chat_history.extend(loaded_history)
+    # only the newest messages are loaded, so even a huge thread resumes right away
+    if await chat_history_saver.load_chat_history(sessions.current()):
         await cl.Message("Chat history loaded.").send()
     else:
         await cl.Message("No chat history loaded.").send()
-    await cl.Message("You may now continue the conversation.").send()
\ No newline at end of file
+    await cl.Message("You may now continue the conversation.").send()
+
+@cl.action_callback("search_chat_history")
+async def search_chat_history_action():
+    if await chat_history_saver.search_chat_history(sessions.current()):
+        await cl.Message("You may now continue the conversation.").send()
+
+@cl.action_callback("show_earlier_messages")
+async def show_earlier_messages_action():
+    await chat_history_saver.show_earlier(sessions.current())
+
+@cl.on_chat_end
+async def on_chat_end():
+    await autosave.flush()
+    sessions.drop() # it's in the store now, and every chat starts over with a fresh state anyway
+
+@cl.on_app_shutdown
+async def on_app_shutdown():
+    print("Flushing autosaved chats...")
+    await autosave.close()
+    await close_clients()
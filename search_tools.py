@@ -0,0 +1,206 @@
+## Caching and request coalescing for the Tavily tools, plus a fake Tavily backend for offline testing
+# cached_search_tool / cached_extract_tool wrap TavilySearch / TavilyExtract in tools with the same name and arguments,
+# so the agent (and ResponseCache's bypass list) can't tell the difference.
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+from urllib.parse import urlsplit, urlunsplit
+from langchain_core.tools import StructuredTool
+from langchain_tavily import TavilySearch, TavilyExtract
+from langchain_tavily._utilities import TavilySearchAPIWrapper, TavilyExtractAPIWrapper
+from cache_tools import ToolResultCache
+
+
+def normalize_query(query):
+    return " ".join(str(query).split()).casefold()
+
+def normalize_url(url):
+    """Lowercase scheme and host, drop the fragment and any trailing slash, so trivially different URLs share a cache entry."""
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), parts.query, ""))
+
+
+class PageStore:
+    """Size-bounded SQLite store of extracted pages (one row per URL and extract settings) that survives restarts.
+
+    Pages older than ttl_seconds are treated as missing. Past max_bytes the least recently used quarter is evicted.
+    """
+    def __init__(self, db_path, max_bytes=256 * 1024 * 1024, ttl_seconds=24 * 3600):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, page TEXT, fetched REAL, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self.db.commit()
+        self.db_bytes = self.db.execute("SELECT COALESCE(SUM(LENGTH(page)), 0) FROM pages").fetchone()[0]
+
+    def get_many(self, keys):
+        """key -> page dict for the keys that are stored and fresh."""
+        found = {}
+        with self.lock:
+            now = time.time()
+            for key in keys:
+                row = self.db.execute("SELECT page, fetched FROM pages WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] <= self.ttl_seconds:
+                    found[key] = json.loads(row[0])
+            if found:
+                self.db.executemany("UPDATE pages SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self.db.commit()
+        return found
+
+    def put_many(self, pages):
+        with self.lock:
+            now = time.time()
+            rows = [(key, json.dumps(page), now, now) for key, page in pages.items()]
+            self.db.executemany("INSERT OR REPLACE INTO pages (key, page, fetched, last_used) VALUES (?, ?, ?, ?)", rows)
+            self.db_bytes += sum(len(row[1]) for row in rows)
+            if self.db_bytes > self.max_bytes:
+                count = self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+                self.db.execute(
+                    "DELETE FROM pages WHERE rowid IN (SELECT rowid FROM pages ORDER BY last_used LIMIT ?)",
+                    (max(1, count // 4),),
+                )
+                self.db_bytes = self.db.execute("SELECT COALESCE(SUM(LENGTH(page)), 0) FROM pages").fetchone()[0]
+            self.db.commit()
+
+    async def aget_many(self, keys):
+        return await asyncio.to_thread(self.get_many, keys)
+
+    async def aput_many(self, pages):
+        await asyncio.to_thread(self.put_many, pages)
+
+
+def _wrap(tool, coroutine):
+    return StructuredTool(
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        coroutine=coroutine,
+        handle_tool_error=tool.handle_tool_error,
+    )
+
+def cached_search_tool(tool, cache=None):
+    """TavilySearch with a TTL cache keyed on the normalized query and the other arguments.
+    Identical searches from different sessions at the same time share one request."""
+    cache = cache or ToolResultCache()
+    async def search(**kwargs):
+        key = json.dumps({**kwargs, "query": normalize_query(kwargs.get("query", ""))}, sort_keys=True, default=str)
+        return await cache.fetch(key, lambda: tool.ainvoke(kwargs))
+    return _wrap(tool, search)
+
+def cached_extract_tool(tool, cache=None, pages=None):
+    """TavilyExtract with a TTL cache and coalescing keyed on the normalized URLs,
+    and optionally a PageStore so each page is only extracted once across restarts.
+    Responses where some URLs failed aren't cached, so those get retried; the pages that worked are in the PageStore."""
+    cache = cache or ToolResultCache()
+    async def extract(urls, **kwargs):
+        settings = json.dumps(kwargs, sort_keys=True, default=str) # e.g. extract_depth changes what comes back
+        keys = {url: f"{settings} {normalize_url(url)}" for url in urls}
+
+        async def fetch():
+            stored = await pages.aget_many(list(keys.values())) if pages else {}
+            missing = [url for url in urls if keys[url] not in stored]
+            response = {"results": [], "failed_results": []}
+            if missing:
+                response = await tool.ainvoke({**kwargs, "urls": missing})
+                if isinstance(response, str): # the tool's handled error when none of the URLs could be extracted
+                    response = {"results": [], "failed_results": [{"url": url, "error": response} for url in missing]}
+                if "error" in response:
+                    return response
+                fetched = {f"{settings} {normalize_url(page['url'])}": page for page in response.get("results", [])}
+                if pages and fetched:
+                    await pages.aput_many(fetched)
+                stored.update(fetched)
+            results = [stored[keys[url]] for url in urls if keys[url] in stored]
+            requested = set(keys.values())
+            results += [page for key, page in stored.items() if key not in requested] # came back under a different URL
+            return {**response, "results": results}
+
+        return await cache.fetch(settings + " " + " ".join(sorted(keys.values())), fetch)
+    return _wrap(tool, extract)
+
+
+# A stand-in for the Tavily API: deterministic results after a fake network delay, counting the requests it gets.
+# TavilySearch(api_wrapper=FakeTavilySearchAPIWrapper(tavily_api_key="fake")) behaves like the real tool without a key or network.
+class FakeTavilySearchAPIWrapper(TavilySearchAPIWrapper):
+    latency: float = 0.2
+    calls: int = 0
+
+    def _results(self, query, max_results=5, **kwargs):
+        self.calls += 1
+        slug = "-".join(normalize_query(query).split())
+        return {
+            "query": query,
+            "results": [
+                {"title": f"Result {i} for {query}", "url": f"https://example.com/{slug}/{i}",
+                 "content": f"Fake search result {i} about {query}.", "score": 1.0 - i / 10}
+                for i in range(max_results or 5)
+            ],
+            "response_time": self.latency,
+        }
+
+    def raw_results(self, query, max_results=5, **kwargs):
+        time.sleep(self.latency)
+        return self._results(query, max_results)
+
+    async def raw_results_async(self, query, max_results=5, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._results(query, max_results)
+
+class FakeTavilyExtractAPIWrapper(TavilyExtractAPIWrapper):
+    """URLs containing "fail" come back in failed_results."""
+    latency: float = 0.5
+    calls: int = 0
+
+    def _results(self, urls, **kwargs):
+        self.calls += 1
+        return {
+            "results": [{"url": url, "raw_content": f"Fake page content for {url}."} for url in urls if "fail" not in url],
+            "failed_results": [{"url": url, "error": "Failed to fetch url"} for url in urls if "fail" in url],
+            "response_time": self.latency,
+        }
+
+    def raw_results(self, urls, **kwargs):
+        time.sleep(self.latency)
+        return self._results(urls)
+
+    async def raw_results_async(self, urls, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._results(urls)
+
+def fake_tavily_tools(search_latency=0.2, extract_latency=0.5, **search_kwargs):
+    """(TavilySearch, TavilyExtract) backed by the fakes above."""
+    search = TavilySearch(api_wrapper=FakeTavilySearchAPIWrapper(tavily_api_key="fake", latency=search_latency), **search_kwargs)
+    extract = TavilyExtract(apiwrapper=FakeTavilyExtractAPIWrapper(tavily_api_key="fake", latency=extract_latency))
+    return search, extract
+
+
+async def benchmark_cache(n_sessions=10):
+    """n_sessions ask the same thing at once, then again; count the requests that reach the (fake) backend."""
+    search, extract = fake_tavily_tools(max_results=5)
+    cached_search = cached_search_tool(search)
+    cached_extract = cached_extract_tool(extract)
+    queries = ["Who won the 2022 World Cup?", "who won the 2022  world cup?"] # normalize to the same key
+    urls = ["https://Example.com/a/", "https://example.com/a#intro"]
+
+    for name, tool, args in [
+        ("search", cached_search, lambda i: {"query": queries[i % 2]}),
+        ("extract", cached_extract, lambda i: {"urls": [urls[i % 2]]}),
+    ]:
+        start = time.perf_counter()
+        await asyncio.gather(*(tool.ainvoke(args(i)) for i in range(n_sessions)))
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        await tool.ainvoke(args(0))
+        repeat = time.perf_counter() - start
+        backend = (search if name == "search" else extract)
+        calls = (backend.api_wrapper if name == "search" else backend.apiwrapper).calls
+        print(f"{name}: {n_sessions} concurrent calls took {first:.2f}s with {calls} backend request(s); repeat took {repeat * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(benchmark_cache())
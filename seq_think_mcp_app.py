@@ -1,21 +1,22 @@
 import json
 import chainlit as cl
 from langchain_core.tools import tool 
-from tools import create_react_tool_agent
+from tools import create_react_tool_agent, get_embeddings
+from chainlit_tools import SessionStore, stream_agent_response
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 import app_memory_hook
-from langchain_mcp_adapters.client import MultiServerMCPClient
-import asyncio
+from mcp_tools import MCPSessionPool
+from mem0_tools import CachedEmbeddings
+from attachment_tools import AttachmentStore, ingest_files, referenced_files
 
-client = MultiServerMCPClient({
+# One long-lived session per server; tool calls reuse it instead of spawning npx every time
+mcp_pool = MCPSessionPool({
     "sequential_thinking": {
         "command": "npx",
         "args": ["-y", "@modelcontextprotocol/server-sequential-thinking"],
         "transport": "stdio",
     }
-})
-#mcp_tools = await client.get_tools() # this got an error from running await outside a function
-mcp_tools = asyncio.run(client.get_tools())  # Use asyncio.run to get tools in
+}, schema_cache_dir="mcp_schema_cache")
 
 
 with open("config.json", "r") as f:
@@ -24,22 +25,41 @@ with open("config.json", "r") as f:
 model = config["openai"]["default_model"]
 api_key = config["openai"]["api_key"]
 
-chat_history = []
+sessions = SessionStore(**config.get("sessions", {})) # history per chat, instead of one global list
+embedding_model = "text-embedding-3-small"
+embeddings = CachedEmbeddings(get_embeddings(model=embedding_model, api_key=api_key), model=embedding_model)
+# files are stored once by content hash and shared by all sessions
+attachments = AttachmentStore(embeddings, model=model, store_dir=config.get("attachments", {}).get("store_dir", "attachment_store"))
 
 
-agent = create_react_tool_agent(
-    model=model,
-    api_key=api_key,
-    tools=mcp_tools,  # Use the MCP tools loaded from the client
-)
+agent = None # built in on_app_startup, once we know the MCP tools
+
+def build_agent(mcp_tools):
+    global agent
+    agent = create_react_tool_agent(
+        model=model,
+        api_key=api_key,
+        tools=mcp_tools,  # from the MCP servers, or the schema cache on a warm start
+    )
+    app_memory_hook.agent = agent
 
 # So I can see these variables from a notebook running this app as a thread
-app_memory_hook.chat_history = chat_history
-app_memory_hook.agent = agent
+app_memory_hook.sessions = sessions
+app_memory_hook.mcp_pool = mcp_pool
+
+@cl.on_app_startup
+async def on_app_startup():
+    # Tool discovery happens here instead of at import, on Chainlit's own event loop.
+    # A warm start uses the cached schemas right away and re-lists the tools in the background (rebuilding the agent if they changed).
+    build_agent(await mcp_pool.load_tools(on_change=build_agent))
+
+@cl.on_app_shutdown
+async def on_app_shutdown():
+    await mcp_pool.close()
 
 @cl.on_chat_start
 async def on_chat_start():   
-    chat_history.clear()  # Clear chat history at the start of each chat  
+    chat_history = sessions.reset().history  # Fresh history at the start of each chat
     intro_message = AIMessage(f"Welcome to the Chainlit app! I can perform long division and read file attachments. Try sending me a message or attaching a file.")
     chat_history.append(intro_message)
     await cl.Message(content=intro_message.content).send()
@@ -49,19 +69,19 @@ async def on_chat_start():
 async def on_message(message: cl.Message):
     print(f"=== MESSAGE RECEIVED: {message.content} ===")
     input = message.content
-    if message.elements:
+    chat_history = sessions.current().history
+    # Attachments are stored once by content hash (read off the event loop, chunked and indexed);
+    # the history just gets a small reference to each, which the context builder expands into the relevant chunks
+    file_references = await ingest_files(message, attachments)
+    if file_references:
         print("=== FILE ATTACHMENTS RECEIVED ===")
-        for element in message.elements:
-            if element.type == "file" and (element.mime == "text/plain" or not element.mime): 
-                file_name = element.name if element.name else "(unknown file name)"
-                with open(element.path, "r") as f:
-                    file_text = f.read()
-                file_input = f"File name: {file_name}\nFile content:\n{file_text}"
-                chat_history.append(HumanMessage(content=file_input))
+        chat_history.extend(file_references)
+    relevant_chunks = await attachments.arelevant_messages(input, referenced_files(chat_history))
     
-    response = await agent.ainvoke({
+    # Tokens and tool calls show up in the UI as they happen
+    response = await stream_agent_response(agent, {
         "input": input,
-        "chat_history": chat_history,
+        "chat_history": chat_history + relevant_chunks,
     })
     output = response["output"]
     if response["intermediate_steps"]:
@@ -72,6 +92,9 @@ async def on_message(message: cl.Message):
     chat_history.append(HumanMessage(content=input))
     chat_history.append(AIMessage(content=output))
 
-    print(f"=== SENDING RESPONSE: {output} ===")
-    # Send the response back to the user
-    await cl.Message(content=output).send()
+    print(f"=== SENT RESPONSE: {output} ===")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    sessions.drop() # every chat starts over with a fresh state, so don't keep this one (or its spill file) around
@@ -0,0 +1,39 @@
+## A tiny stdio MCP server for trying out mcp_tools.MCPSessionPool without npx or the network
+# python stub_mcp_server.py  (normally started by the pool, see mcp_tools.py)
+import os
+import time
+import asyncio
+from mcp.server.fastmcp import FastMCP
+
+server = FastMCP("stub", log_level="WARNING")
+
+@server.tool()
+def echo(text: str) -> str:
+    """Return the text unchanged."""
+    return text
+
+@server.tool()
+def add(a: int, b: int) -> int:
+    """Add two integers."""
+    return a + b
+
+@server.tool()
+async def wait(seconds: float) -> str:
+    """Sleep for a while, for testing concurrency and timeouts."""
+    await asyncio.sleep(seconds)
+    return f"waited {seconds}s"
+
+@server.tool()
+def pid() -> int:
+    """The server's process id, so you can tell when it was restarted."""
+    return os.getpid()
+
+@server.tool()
+def crash() -> str:
+    """Exit the server process immediately, for testing restarts."""
+    os._exit(1)
+
+if __name__ == "__main__":
+    if os.environ.get("STUB_MCP_STARTUP_DELAY"): # pretend to be slow to start, like npx -y
+        time.sleep(float(os.environ["STUB_MCP_STARTUP_DELAY"]))
+    server.run("stdio")
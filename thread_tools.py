@@ -0,0 +1,728 @@
+## Saved chat threads in one SQLite file (WAL mode) instead of one pretty-printed JSON file per save
+# Every message is a row, so saving a thread that grew by two messages writes two rows, not the whole history.
+# The threads table is the index: name, message count, size and times, so listing threads doesn't read any messages.
+# Loading can be paginated (load_recent / load_page), so resuming a long thread only builds the newest messages.
+# Message text is also kept in an FTS5 index (filled by triggers, so it's updated in the same transaction as every save),
+# and ThreadSearch adds optional vector search on top of it. Autosaver writes chats in batches in the background.
+# Threads can also be kept as compressed JSONL archives (see write_archive), and load_thread_file reads those
+# as well as the two older formats: conversations/conversation_*.json and saved_threads/*.json.
+# python thread_tools.py converts the old files to archives and reports sizes and load times;
+# python thread_tools.py --benchmark-search times keyword search over 100k messages.
+import os
+import io
+import sys
+import glob
+import gzip
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import asyncio
+import numpy as np
+from langchain_core.messages import messages_from_dict
+from mem0_tools import MatrixVectorStore
+try:
+    import zstandard
+except ImportError: # archives are written with gzip instead
+    zstandard = None
+
+
+def message_to_record(message):
+    """The fields of a message we actually use (no empty response_metadata, id, name, ...)."""
+    record = {"type": message.type, "content": message.content}
+    if message.additional_kwargs:
+        record["additional_kwargs"] = message.additional_kwargs
+    return record
+
+def message_from_record(record):
+    data = {k: record[k] for k in ("content", "additional_kwargs") if k in record} # archives may also carry a timestamp
+    return messages_from_dict([{"type": record["type"], "data": data}])[0]
+
+def _dumps(message):
+    return json.dumps(message_to_record(message), ensure_ascii=False)
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _chain(previous, text):
+    """Hash of a whole thread up to and including this message: each message's digest folded into the one before."""
+    return _digest((previous or "") + _digest(text))
+
+
+class ThreadStore:
+    """Named chat threads in an SQLite database: a threads index table plus one row per message.
+
+    save() appends just the new messages when the stored thread is the start of the one being saved
+    (checked with a chained hash of every stored message, kept per row), and rewrites the thread otherwise.
+    A session that only loaded the tail of a thread passes offset (the seq of its first message), so it can
+    save back into the same thread without having the older messages in memory.
+    The a* methods run the same thing in a worker thread, for use from Chainlit callbacks.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL") # with WAL this is still crash-safe, it just may lose the last commit on power loss
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            "name TEXT PRIMARY KEY, message_count INTEGER, bytes INTEGER, created REAL, updated REAL, last_hash TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "thread TEXT, seq INTEGER, message TEXT, created REAL, chain TEXT, PRIMARY KEY (thread, seq))"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(threads)")]
+        if "summary" not in columns: # databases from before summaries were stored
+            self.db.execute("ALTER TABLE threads ADD COLUMN summary TEXT")
+        if "chain" not in [row[1] for row in self.db.execute("PRAGMA table_info(messages)")]:
+            self._add_chains() # databases from before last_hash covered the whole thread
+        self._create_search_index()
+        self.db.commit()
+        # rowids are handed out by us and only ever go up, so "messages after rowid N" (ThreadSearch.aupdate)
+        # never misses a message that reused the rowid of a deleted one
+        self.next_rowid = self.db.execute("SELECT COALESCE(MAX(rowid), 0) FROM messages").fetchone()[0] + 1
+
+    def _add_chains(self):
+        self.db.execute("ALTER TABLE messages ADD COLUMN chain TEXT")
+        for (name,) in self.db.execute("SELECT name FROM threads").fetchall():
+            chain = ""
+            for rowid, message in self.db.execute(
+                "SELECT rowid, message FROM messages WHERE thread = ? ORDER BY seq", (name,)
+            ).fetchall():
+                chain = _chain(chain, message)
+                self.db.execute("UPDATE messages SET chain = ? WHERE rowid = ?", (chain, rowid))
+            self.db.execute("UPDATE threads SET last_hash = ? WHERE name = ?", (chain, name))
+
+    def _create_search_index(self):
+        """Keyword index over message text, sharing rowids with messages and kept in step with it by triggers."""
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_search'").fetchone()
+        self.db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(text, thread UNINDEXED, seq UNINDEXED)"
+        )
+        self.db.execute(
+            "CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN "
+            "INSERT INTO message_search (rowid, text, thread, seq) "
+            "VALUES (new.rowid, json_extract(new.message, '$.content'), new.thread, new.seq); END"
+        )
+        self.db.execute(
+            "CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages BEGIN "
+            "DELETE FROM message_search WHERE rowid = old.rowid; END"
+        )
+        if not exists: # databases from before there was an index
+            self.db.execute(
+                "INSERT INTO message_search (rowid, text, thread, seq) "
+                "SELECT rowid, json_extract(message, '$.content'), thread, seq FROM messages"
+            )
+
+    def exists(self, name):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM threads WHERE name = ?", (name,)).fetchone() is not None
+
+    def save(self, name, messages, offset=0, summary=None, overwrite=False):
+        """Save messages as thread name, messages[0] being message number offset of the thread.
+        Only appends unless overwrite: if the stored thread isn't the start of messages (say another chat saved to it
+        since it was loaded) this raises ValueError rather than replacing it. Returns how many message rows were written."""
+        with self.lock:
+            try:
+                written = self._save(name, messages, offset, summary, overwrite)
+            except Exception:
+                self.db.rollback()
+                raise
+            self.db.commit()
+            return written
+
+    def save_many(self, threads, overwrite=False):
+        """Save several (name, messages, offset, summary) threads in one transaction, so one commit covers them all.
+        Returns, for each, the number of rows written or the ValueError that stopped it being saved."""
+        results = []
+        with self.lock:
+            try:
+                for name, messages, offset, summary in threads:
+                    try:
+                        results.append(self._save(name, messages, offset, summary, overwrite))
+                    except ValueError as e:
+                        results.append(e)
+            except Exception:
+                self.db.rollback() # all or nothing
+                raise
+            self.db.commit()
+        return results
+
+    def _save(self, name, messages, offset, summary, overwrite):
+        """The writes for save(), without the commit. Raises ValueError before writing anything."""
+        row = self.db.execute("SELECT message_count, last_hash, bytes FROM threads WHERE name = ?", (name,)).fetchone()
+        base = ""
+        if offset:
+            # the chain up to the first message we have in memory comes from the stored row before it
+            found = row and self.db.execute("SELECT chain FROM messages WHERE thread = ? AND seq = ?", (name, offset - 1)).fetchone()
+            base = found[0] if found else None
+        if base is None:
+            raise ValueError(f"Can't save from message {offset} on: {name} doesn't have the messages before it")
+        start, size, chain = 0, 0, ""
+        appending = not row or (not offset and not row[0]) # a new (or empty) thread
+        if row and offset < row[0] <= offset + len(messages):
+            prefix = base
+            for message in messages[:row[0] - offset]:
+                prefix = _chain(prefix, _dumps(message))
+            if prefix == row[1]: # the whole stored thread, not just its last message, is the start of this one
+                start, size, chain, appending = row[0], row[2], prefix, True
+        if not appending:
+            if not overwrite:
+                raise ValueError(f"{name} has changed since these messages were loaded from it, and overwrite wasn't set")
+            if offset:
+                raise ValueError(f"Can't overwrite {name} from message {offset} on: pass the whole thread")
+            self.db.execute("DELETE FROM messages WHERE thread = ?", (name,))
+        now = time.time()
+        # another process may have written to the file since, so don't go below its rowids either
+        self.next_rowid = max(self.next_rowid, self.db.execute("SELECT COALESCE(MAX(rowid), 0) FROM messages").fetchone()[0] + 1)
+        rows = []
+        for i, message in enumerate(messages[start - offset:]):
+            text = _dumps(message)
+            chain = _chain(chain, text)
+            rows.append((self.next_rowid + i, name, start + i, text, now, chain))
+        self.db.executemany("INSERT INTO messages (rowid, thread, seq, message, created, chain) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.next_rowid += len(rows)
+        size += sum(len(row[3]) for row in rows)
+        last_hash = chain
+        self.db.execute(
+            "INSERT INTO threads (name, message_count, bytes, created, updated, last_hash, summary) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET message_count = excluded.message_count, bytes = excluded.bytes, "
+            "updated = excluded.updated, last_hash = excluded.last_hash, summary = COALESCE(excluded.summary, summary)",
+            (name, offset + len(messages), size, now, now, last_hash, summary),
+        )
+        return len(rows)
+
+    def load(self, name):
+        """All of a thread's messages, or None if there's no such thread."""
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM threads WHERE name = ?", (name,)).fetchone() is None:
+                return None
+            rows = self.db.execute("SELECT message FROM messages WHERE thread = ? ORDER BY seq", (name,)).fetchall()
+        return [message_from_record(json.loads(row[0])) for row in rows]
+
+    def load_recent(self, name, n=50):
+        """The newest n messages of a thread plus its stored summary, without touching the older rows:
+        a dict with messages, offset (the seq of the first one), message_count and summary. None if there's no such thread."""
+        with self.lock:
+            thread = self.db.execute("SELECT message_count, summary FROM threads WHERE name = ?", (name,)).fetchone()
+            if thread is None:
+                return None
+            rows = self.db.execute(
+                "SELECT message FROM messages WHERE thread = ? ORDER BY seq DESC LIMIT ?", (name, n)
+            ).fetchall()
+        messages = [message_from_record(json.loads(row[0])) for row in reversed(rows)]
+        return {"messages": messages, "offset": thread[0] - len(messages), "message_count": thread[0], "summary": thread[1]}
+
+    def load_page(self, name, before, n=50):
+        """Up to n messages just before message number before, oldest first (e.g. for "show earlier")."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT message FROM messages WHERE thread = ? AND seq < ? ORDER BY seq DESC LIMIT ?", (name, before, n)
+            ).fetchall()
+        return [message_from_record(json.loads(row[0])) for row in reversed(rows)]
+
+    def search(self, query, limit=20):
+        """Messages matching every word of query, best (bm25) first:
+        dicts with rowid, thread, seq, type, snippet (matches in **bold**) and score (lower is better)."""
+        words = query.split()
+        if not words:
+            return []
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in words) # user text, not FTS syntax
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT s.rowid, s.thread, s.seq, json_extract(m.message, '$.type'), "
+                "snippet(message_search, 0, '**', '**', '…', 16), s.rank "
+                "FROM message_search s JOIN messages m ON m.rowid = s.rowid "
+                "WHERE message_search MATCH ? ORDER BY s.rank LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        return [dict(zip(("rowid", "thread", "seq", "type", "snippet", "score"), row)) for row in rows]
+
+    def messages_after(self, rowid, limit=1000):
+        """(rowid, thread, seq, type, content) for up to limit messages stored after rowid, for incremental indexing."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT rowid, thread, seq, json_extract(message, '$.type'), json_extract(message, '$.content') "
+                "FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (rowid, limit),
+            ).fetchall()
+
+    def message_rowids(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT rowid FROM messages")}
+
+    def messages_by_rowid(self, rowids):
+        """rowid -> (thread, seq, type, content) for the rowids that still exist."""
+        if not rowids:
+            return {}
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT rowid, thread, seq, json_extract(message, '$.type'), json_extract(message, '$.content') "
+                f"FROM messages WHERE rowid IN ({','.join('?' * len(rowids))})",
+                list(rowids),
+            ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def list_threads(self):
+        """Index rows for every thread, most recently updated first: dicts with name, message_count, bytes, created, updated."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, message_count, bytes, created, updated FROM threads ORDER BY updated DESC"
+            ).fetchall()
+        return [dict(zip(("name", "message_count", "bytes", "created", "updated"), row)) for row in rows]
+
+    def delete(self, name):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE thread = ?", (name,))
+            self.db.execute("DELETE FROM threads WHERE name = ?", (name,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    async def aexists(self, name):
+        return await asyncio.to_thread(self.exists, name)
+
+    async def asave(self, name, messages, offset=0, summary=None, overwrite=False):
+        return await asyncio.to_thread(self.save, name, list(messages), offset, summary, overwrite)
+
+    async def asave_many(self, threads, overwrite=False):
+        threads = [(name, list(messages), offset, summary) for name, messages, offset, summary in threads]
+        return await asyncio.to_thread(self.save_many, threads, overwrite)
+
+    async def aload(self, name):
+        return await asyncio.to_thread(self.load, name)
+
+    async def aload_recent(self, name, n=50):
+        return await asyncio.to_thread(self.load_recent, name, n)
+
+    async def aload_page(self, name, before, n=50):
+        return await asyncio.to_thread(self.load_page, name, before, n)
+
+    async def asearch(self, query, limit=20):
+        return await asyncio.to_thread(self.search, query, limit)
+
+    async def alist_threads(self):
+        return await asyncio.to_thread(self.list_threads)
+
+    async def adelete(self, name):
+        return await asyncio.to_thread(self.delete, name)
+
+
+class ThreadSearch:
+    """Search over every saved thread: ThreadStore's FTS5 keyword index, plus vector search when given embeddings
+    (e.g. the app's mem0_tools.CachedEmbeddings), with the two rankings merged by reciprocal rank fusion.
+
+    The vectors live in a mem0_tools.MatrixVectorStore keyed by message rowid, and are also appended to
+    vectors_path (default: next to the store, <name>.vectors.sqlite), so a restart loads them instead of re-embedding.
+    The watermark is the highest rowid stored there; aupdate() embeds only the messages saved after it.
+    Loading and catching up run in the background (schedule_update()); until they're done, searches are keyword-only.
+    Vectors of messages that were since deleted (a thread overwritten) are dropped when they turn up in a search.
+    """
+    def __init__(self, store, embeddings=None, index="flat", batch_size=256, max_chars=4000, vectors_path=None):
+        self.store = store
+        self.embeddings = embeddings
+        self.vectors = MatrixVectorStore(embeddings, index=index) if embeddings else None
+        self.batch_size = batch_size
+        self.max_chars = max_chars # long messages are embedded by their start
+        self.vectors_path = vectors_path or os.path.splitext(store.db_path)[0] + ".vectors.sqlite"
+        self.vector_db = None
+        self.last_rowid = 0
+        self.ready = False # the saved vectors are loaded and every message has been embedded at least once
+        self.update_task = None
+        self.lock = asyncio.Lock()
+
+    def _load_vectors(self):
+        """Open vectors_path and return the saved (rowids, matrix), dropping them if they came from another model."""
+        model = getattr(self.embeddings, "model", None)
+        db = sqlite3.connect(self.vectors_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS message_vectors (rowid INTEGER PRIMARY KEY, vector BLOB)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = db.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row is None or row[0] != str(model):
+            db.execute("DELETE FROM message_vectors")
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('model', ?)", (str(model),))
+        db.commit()
+        self.vector_db = db
+        rows = db.execute("SELECT rowid, vector FROM message_vectors ORDER BY rowid").fetchall()
+        if not rows:
+            return [], None
+        matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        return [row[0] for row in rows], matrix
+
+    def _save_vectors(self, rowids, vectors):
+        rows = [(rowid, np.asarray(vector, dtype=np.float32).tobytes()) for rowid, vector in zip(rowids, vectors)]
+        self.vector_db.executemany("INSERT OR REPLACE INTO message_vectors (rowid, vector) VALUES (?, ?)", rows)
+        self.vector_db.commit()
+
+    def _forget_vectors(self, rowids):
+        self.vector_db.executemany("DELETE FROM message_vectors WHERE rowid = ?", [(rowid,) for rowid in rowids])
+        self.vector_db.commit()
+
+    def schedule_update(self):
+        """Load the saved vectors (the first time) and embed new messages, in a background task. Returns the task."""
+        if self.vectors is None:
+            return None
+        if self.update_task is None or self.update_task.done():
+            self.update_task = asyncio.create_task(self.aupdate())
+        return self.update_task
+
+    async def aupdate(self):
+        """Embed the messages saved since the last update (loading the saved vectors first, if not done yet).
+        Returns how many were added."""
+        if self.vectors is None:
+            return 0
+        added = 0
+        async with self.lock:
+            if self.vector_db is None:
+                start = time.perf_counter()
+                rowids, matrix = await asyncio.to_thread(self._load_vectors)
+                existing = await asyncio.to_thread(self.store.message_rowids)
+                stale = [rowid for rowid in rowids if rowid not in existing] # threads overwritten while we weren't running
+                if stale:
+                    await asyncio.to_thread(self._forget_vectors, stale)
+                    keep = np.array([rowid in existing for rowid in rowids])
+                    rowids, matrix = [rowid for rowid in rowids if rowid in existing], matrix[keep]
+                if rowids:
+                    self.vectors.add_vectors([str(rowid) for rowid in rowids], [""] * len(rowids), matrix)
+                    self.last_rowid = rowids[-1]
+                print(f"=== Loaded {len(rowids)} saved thread vectors in {time.perf_counter() - start:.2f}s ===")
+            while True:
+                rows = await asyncio.to_thread(self.store.messages_after, self.last_rowid, self.batch_size)
+                if not rows:
+                    break
+                texts = [str(row[4] or "")[:self.max_chars] or " " for row in rows]
+                vectors = await self.embeddings.aembed_documents(texts)
+                await asyncio.to_thread(self._save_vectors, [row[0] for row in rows], vectors)
+                self.vectors.add_vectors([str(row[0]) for row in rows], [""] * len(rows), vectors) # the text stays in SQLite
+                self.last_rowid = rows[-1][0]
+                added += len(rows)
+            self.ready = True
+        return added
+
+    async def _semantic(self, query, limit):
+        if not self.ready:
+            self.schedule_update() # catching up after a restart can take a while; don't make this search wait for it
+            return []
+        self.schedule_update() # messages saved since; they'll show up in later searches
+        if not len(self.vectors):
+            return []
+        vector = await self.embeddings.aembed_query(query)
+        hits = self.vectors.index.search(vector, limit)
+        found = await asyncio.to_thread(self.store.messages_by_rowid, [int(doc_id) for doc_id, _ in hits])
+        stale = [doc_id for doc_id, _ in hits if int(doc_id) not in found]
+        if stale:
+            self.vectors.delete(stale)
+            await asyncio.to_thread(self._forget_vectors, [int(doc_id) for doc_id in stale])
+        return [
+            {"rowid": int(doc_id), "thread": found[int(doc_id)][0], "seq": found[int(doc_id)][1], "type": found[int(doc_id)][2],
+             "snippet": str(found[int(doc_id)][3])[:200], "score": score}
+            for doc_id, score in hits if int(doc_id) in found
+        ]
+
+    async def asearch(self, query, limit=10, rrf_k=60):
+        """The best limit messages for query, as ThreadStore.search dicts; score is the fused score (higher is better)
+        when vector search is on."""
+        keyword = await self.store.asearch(query, limit * 2)
+        if self.vectors is None:
+            return keyword[:limit]
+        semantic = await self._semantic(query, limit * 2)
+        fused = {}
+        for ranking in (keyword, semantic):
+            for rank, hit in enumerate(ranking):
+                entry = fused.setdefault(hit["rowid"], dict(hit, score=0.0))
+                entry["score"] += 1.0 / (rrf_k + rank + 1)
+        return sorted(fused.values(), key=lambda hit: -hit["score"])[:limit]
+
+
+AUTOSAVE_PREFIX = "autosave"
+
+class Autosaver:
+    """Saves chats in the background, so a crash doesn't lose them, without a write per message.
+
+    mark_dirty(state) after a chat changes (state is a chainlit_tools.SessionState, or anything with session_id,
+    history, history_offset, thread_name and summary). Dirty chats are flushed together, every interval seconds
+    or as soon as max_pending messages are waiting, with one ThreadStore.save_many transaction in a worker thread.
+    Each chat goes to the thread it was loaded from / saved as, or to "autosave <session id>" if it has none yet;
+    only its new messages are written. A thread is never overwritten: if another chat changed it since it was loaded,
+    this chat is autosaved to a copy, "<thread> (autosave <session id>)", from then on.
+    Call forget(state) once a chat is saved under a name, which deletes its autosave thread; autosave threads
+    not touched for max_age seconds are deleted when the timer starts. close() stops the timer and does a last flush.
+    """
+    def __init__(self, store, interval=10.0, max_pending=100, name_prefix=AUTOSAVE_PREFIX, max_age=7 * 24 * 3600):
+        self.store = store
+        self.interval = interval
+        self.max_pending = max_pending
+        self.name_prefix = name_prefix
+        self.max_age = max_age
+        self.dirty = {} # session id -> state
+        self.saved_lengths = {} # session id -> thread length at the last flush
+        self.forks = {} # session id -> (thread it was loaded from, the copy it goes to instead, messages before history_offset)
+        self.pending = 0
+        self.wake = asyncio.Event()
+        self.task = None
+        self.flush_lock = asyncio.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+
+    def thread_name(self, state):
+        fork = self.forks.get(state.session_id)
+        if fork and fork[0] == state.thread_name:
+            return fork[1]
+        return state.thread_name or f"{self.name_prefix} {state.session_id}"
+
+    def _length(self, state):
+        return state.history_offset + len(state.history)
+
+    def _snapshot(self, state):
+        """(name, messages, offset, summary) to save for state."""
+        fork = self.forks.get(state.session_id)
+        if fork and fork[0] == state.thread_name:
+            # the copy was started from the whole thread, so it gets the messages that were never paged in too
+            return (fork[1], fork[2][:state.history_offset] + list(state.history), 0, state.summary or None)
+        self.forks.pop(state.session_id, None) # resumed or saved as something else since
+        return (self.thread_name(state), list(state.history), state.history_offset, state.summary or None)
+
+    def mark_dirty(self, state):
+        """Note that state changed; starts the background task if it isn't running."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        self.dirty[state.session_id] = state
+        self.pending = sum(max(1, self._length(s) - self.saved_lengths.get(s.session_id, 0)) for s in self.dirty.values())
+        if self.pending >= self.max_pending:
+            self.wake.set()
+
+    async def _run(self):
+        try:
+            await self.prune()
+        except Exception as e:
+            print(f"=== Couldn't prune old autosaves: {e!r} ===")
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"=== Autosave failed, will retry: {e!r} ===")
+
+    async def prune(self):
+        """Delete autosave threads that haven't been written to for max_age seconds. Returns their names."""
+        cutoff = time.time() - self.max_age
+        old = [thread["name"] for thread in await self.store.alist_threads()
+               if thread["name"].startswith(f"{self.name_prefix} ") and thread["updated"] < cutoff]
+        for name in old:
+            await self.store.adelete(name)
+        if old:
+            print(f"=== Deleted {len(old)} autosaves older than {self.max_age / 86400:g} days ===")
+        return old
+
+    async def forget(self, state):
+        """state was just saved under a name: delete its autosave thread (and stop writing to a copy, if it had one)."""
+        async with self.flush_lock: # so a flush that started before the save can't write the autosave back
+            self.forks.pop(state.session_id, None)
+            await self.store.adelete(f"{self.name_prefix} {state.session_id}")
+
+    async def _fork(self, state):
+        """Send state's autosaves to a copy of its thread from now on, rather than overwriting what another chat saved."""
+        # best effort: the messages before history_offset are taken from the thread as it is now
+        earlier = await self.store.aload_page(state.thread_name, state.history_offset, state.history_offset) if state.history_offset else []
+        self.forks[state.session_id] = (state.thread_name, f"{state.thread_name} ({self.name_prefix} {state.session_id})", earlier)
+        self.saved_lengths.pop(state.session_id, None)
+        self.dirty.setdefault(state.session_id, state)
+        print(f"=== {state.thread_name} was changed by another chat, autosaving {state.session_id} to {self.thread_name(state)} instead ===")
+
+    async def flush(self):
+        """Write every dirty chat now, in one transaction. Returns how many message rows were written."""
+        async with self.flush_lock: # flushes go in order, so a later snapshot never lands before an earlier one
+            if not self.dirty:
+                return 0
+            batch, self.dirty, self.pending = self.dirty, {}, 0
+            # the snapshot is taken on the event loop, so no message is half appended
+            states = list(batch.values())
+            threads = [self._snapshot(s) for s in states]
+            start = time.perf_counter()
+            try:
+                results = await self.store.asave_many(threads)
+            except Exception:
+                for session_id, state in batch.items():
+                    self.dirty.setdefault(session_id, state) # try again next time
+                raise
+            written = 0
+            for state, thread, result in zip(states, threads, results):
+                if isinstance(result, ValueError):
+                    if state.thread_name and state.session_id not in self.forks:
+                        await self._fork(state) # written next flush
+                    else:
+                        print(f"=== Couldn't autosave {thread[0]}: {result} ===")
+                    continue
+                written += result
+                self.saved_lengths[state.session_id] = thread[2] + len(thread[1])
+            self.flushes += 1
+            self.rows_written += written
+            print(f"=== Autosaved {len(threads)} chats ({written} messages) in {(time.perf_counter() - start) * 1000:.1f}ms ===")
+            return written
+
+    async def close(self):
+        """Stop the timer and flush whatever is left, e.g. from an on_app_shutdown hook."""
+        if self.task and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        await self.flush()
+
+    def stats(self):
+        return {"flushes": self.flushes, "rows_written": self.rows_written, "dirty": len(self.dirty)}
+
+
+## Compressed archives: one JSON object per line, the first one a header ({"format": ARCHIVE_FORMAT, "name", ...}),
+# then one record per message as written by message_to_record, plus a timestamp where the source had one.
+ARCHIVE_FORMAT = "chat-thread-archive/1"
+ARCHIVE_EXTENSIONS = (".jsonl.zst", ".jsonl.gz")
+_legacy_types = {"HumanMessage": "human", "AIMessage": "ai", "SystemMessage": "system"}
+
+def archive_extension():
+    return ".jsonl.zst" if zstandard else ".jsonl.gz"
+
+def thread_name_from_path(path):
+    """saved_threads/foo.json and saved_threads/foo.jsonl.zst are both thread foo."""
+    name = os.path.basename(path)
+    for extension in ARCHIVE_EXTENSIONS + (".json",):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+def _open_archive(path, mode, use_zstd=None):
+    """Text-mode stream through the compressor, picked by extension unless use_zstd says otherwise."""
+    if use_zstd if use_zstd is not None else path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd-compressed, pip install zstandard to read it")
+        if mode == "w":
+            return io.TextIOWrapper(zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb"), closefd=True), encoding="utf-8")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True), encoding="utf-8")
+    return gzip.open(path, mode + "t", encoding="utf-8")
+
+def write_archive(path, records, **header):
+    """Stream message records (dicts with type, content and optionally additional_kwargs / timestamp) into an archive.
+    Written to a temp file first, so a crash never leaves half an archive. Returns how many records were written."""
+    count = 0
+    with _open_archive(path + ".tmp", "w", use_zstd=path.endswith(".zst")) as f:
+        f.write(json.dumps({"format": ARCHIVE_FORMAT, **header}, ensure_ascii=False) + "\n")
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(path + ".tmp", path)
+    return count
+
+def iter_archive(path):
+    """(header, records) for an archive; records is a generator reading one line at a time."""
+    f = _open_archive(path, "r")
+    header = json.loads(f.readline())
+    if header.get("format") != ARCHIVE_FORMAT:
+        f.close()
+        raise ValueError(f"{path} isn't a {ARCHIVE_FORMAT} archive")
+    def records():
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    return header, records()
+
+def iter_legacy_records(path):
+    """(header, records) for an old whole-file save, either format, reduced to the fields we use.
+    Each file is one JSON document, so it's parsed in one go, but only one file is in memory at a time
+    and no message objects are built."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    header = {"name": thread_name_from_path(path), "source": os.path.basename(path)}
+    if isinstance(data, dict): # conversations/conversation_*.json: {"timestamp", "messages": [{"type": "HumanMessage", ...}]}
+        header["timestamp"] = data.get("timestamp")
+        messages = data.get("messages", [])
+    else: # saved_threads/*.json: [m.dict() for m in history]
+        messages = data
+    def records():
+        for message in messages:
+            record = {"type": _legacy_types.get(message["type"], message["type"]), "content": message.get("content", "")}
+            if record["type"] not in ("human", "ai", "system"):
+                continue
+            if message.get("additional_kwargs"):
+                record["additional_kwargs"] = message["additional_kwargs"]
+            if message.get("timestamp"):
+                record["timestamp"] = message["timestamp"]
+            yield record
+    return header, records()
+
+def iter_thread_file(path):
+    """(header, records) for any of the three formats."""
+    if path.endswith(ARCHIVE_EXTENSIONS):
+        return iter_archive(path)
+    return iter_legacy_records(path)
+
+def load_thread_file(path):
+    """All the messages in a thread file of any of the three formats."""
+    _, records = iter_thread_file(path)
+    return [message_from_record(record) for record in records]
+
+def convert_to_archive(path, out_dir=None):
+    """Write an archive next to an old save (or into out_dir), leaving the original alone. Returns the archive's path."""
+    header, records = iter_legacy_records(path)
+    out = os.path.join(out_dir or os.path.dirname(path), header["name"] + archive_extension())
+    write_archive(out, records, **header)
+    return out
+
+
+def convert_and_report(paths):
+    """Convert old saves to archives and print how big they are and how long each takes to load, before and after."""
+    total_before = total_after = 0
+    for path in paths:
+        out = convert_to_archive(path)
+        timings = []
+        for p in (path, out):
+            start = time.perf_counter()
+            messages = load_thread_file(p)
+            timings.append(time.perf_counter() - start)
+        before, after = os.path.getsize(path), os.path.getsize(out)
+        total_before += before
+        total_after += after
+        print(f"{path} -> {out}: {len(messages)} messages, {before:,} -> {after:,} bytes ({before / max(after, 1):.1f}x), "
+              f"load {timings[0] * 1000:.1f}ms -> {timings[1] * 1000:.1f}ms")
+    if paths:
+        print(f"total: {total_before:,} -> {total_after:,} bytes ({total_before / max(total_after, 1):.1f}x)")
+
+
+def benchmark_search(n_messages=100_000, thread_size=500, seed=0):
+    """Keyword search latency over n_messages of random chat text, in a throwaway store."""
+    import random
+    import tempfile
+    from langchain_core.messages import HumanMessage, AIMessage
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(5000)] + ["python", "sqlite", "division", "weather", "invoice", "zebra"]
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ThreadStore(os.path.join(tmp, "threads.sqlite"))
+        start = time.perf_counter()
+        for t in range(n_messages // thread_size):
+            store.save(f"thread {t}", [
+                (HumanMessage if i % 2 == 0 else AIMessage)(content=" ".join(rng.choices(vocabulary, k=30)))
+                for i in range(thread_size)
+            ])
+        print(f"saved and indexed {n_messages} messages in {time.perf_counter() - start:.1f}s")
+        for query in ["zebra", "python sqlite", "word42 word43", "nothing-matches-this"]:
+            start = time.perf_counter()
+            for _ in range(20):
+                hits = store.search(query, 10)
+            print(f"{query!r}: {len(hits)} hits, {(time.perf_counter() - start) / 20 * 1000:.1f} ms/query")
+        store.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--benchmark-search"]:
+        benchmark_search()
+    else:
+        # python thread_tools.py [files...]  (default: every old save in conversations/ and saved_threads/)
+        convert_and_report(sys.argv[1:] or sorted(glob.glob("conversations/conversation_*.json") + glob.glob("saved_threads/*.json")))
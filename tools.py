@@ -1,8 +1,14 @@
-from langchain_openai import ChatOpenAI
+import asyncio
+import threading
+import contextvars
+import httpx
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.agents import AgentExecutor, create_openai_tools_agent
+from langchain_core.agents import AgentStep
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import StructuredTool
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+import tiktoken
 
 def tool_method(func):
     """Mark a method to be converted to a LangChain tool"""
@@ -37,13 +43,135 @@ def tool_manager(cls):
     return cls
 
 
+_encodings = {}
+
+def _get_encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # newer models (e.g. gpt-4.1) aren't always in tiktoken's table yet
+            try:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                _encodings[model] = None
+        except Exception:
+            # e.g. offline and the encoding file hasn't been downloaded yet
+            _encodings[model] = None
+    return _encodings[model]
+
+def count_tokens(text, model="gpt-4.1"):
+    """Count tokens locally with tiktoken, falling back to a rough estimate if the encoding isn't available."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens, model="gpt-4.1"):
+    """Cut text down to at most max_tokens tokens (roughly, if tiktoken isn't available)."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+## Shared clients
+# Everything that talks to OpenAI (agents, summarizer, mem0izer, embeddings) goes through the same two httpx
+# connection pools, so connections are kept alive and reused instead of every object opening its own.
+http_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+http_timeout = httpx.Timeout(60.0, connect=10.0)
+_clients = {}
+_clients_lock = threading.RLock() # factories can call get_http_clients while holding it
+
+def _shared(key, factory):
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+def get_http_clients():
+    """The shared (sync, async) httpx clients."""
+    return _shared("http", lambda: (
+        httpx.Client(limits=http_limits, timeout=http_timeout),
+        httpx.AsyncClient(limits=http_limits, timeout=http_timeout),
+    ))
+
+def get_chat_model(model="gpt-4.1", api_key=None, **kwargs):
+    """A ChatOpenAI on the shared connection pools; the same arguments get the same instance back."""
+    def factory():
+        http_client, http_async_client = get_http_clients()
+        return ChatOpenAI(model=model, openai_api_key=api_key, http_client=http_client, http_async_client=http_async_client, **kwargs)
+    return _shared(("chat", model, api_key, tuple(sorted(kwargs.items()))), factory)
+
+def get_embeddings(model="text-embedding-3-small", api_key=None):
+    """An OpenAIEmbeddings on the shared connection pools; the same arguments get the same instance back."""
+    def factory():
+        http_client, http_async_client = get_http_clients()
+        return OpenAIEmbeddings(model=model, api_key=api_key, http_client=http_client, http_async_client=http_async_client)
+    return _shared(("embeddings", model, api_key), factory)
+
+async def close_clients():
+    """Close the shared connection pools, e.g. from an on_app_shutdown hook."""
+    with _clients_lock:
+        http = _clients.pop("http", None)
+        _clients.clear()
+    if http:
+        http[0].close()
+        await http[1].aclose()
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """AgentExecutor whose async path (ainvoke / astream_events) runs the tool calls from one model turn
+    at most max_concurrency at a time, giving up on any call that takes longer than its timeout.
+
+    tool_timeouts maps tool names to seconds; other tools get tool_timeout (None means no limit).
+    A timed-out call comes back to the model as an error observation rather than failing the whole run.
+    Results go into the scratchpad in the order the model asked for them, whichever finishes first.
+    The sync path (invoke) is unchanged and still runs them one by one.
+    """
+    max_concurrency: int = 4
+    tool_timeout: float | None = None
+    tool_timeouts: dict = {}
+
+    async def _aiter_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=None):
+        # one semaphore per model turn; the tool tasks gathered below inherit it through the context
+        _tool_semaphore.set(asyncio.Semaphore(self.max_concurrency))
+        async for item in super()._aiter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager):
+            yield item
+
+    async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        timeout = self.tool_timeouts.get(agent_action.tool, self.tool_timeout)
+        semaphore = _tool_semaphore.get() or asyncio.Semaphore(self.max_concurrency)
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(
+                    super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                print(f"=== Tool {agent_action.tool} timed out after {timeout}s ===")
+                return AgentStep(action=agent_action, observation=f"Error: {agent_action.tool} timed out after {timeout} seconds.")
+
+_tool_semaphore = contextvars.ContextVar("tool_semaphore", default=None)
+
 def create_react_tool_agent(
     model: str = "gpt-4.1",
     api_key: str = None,
     tools: list = [],
-    return_intermediate_steps: bool = True
+    return_intermediate_steps: bool = True,
+    llm = None,
+    parallel_tools: bool = False,
+    max_concurrency: int = 4,
+    tool_timeout: float = None,
+    tool_timeouts: dict = None,
 ):
-    llm = ChatOpenAI(model=model, openai_api_key=api_key)
+    """With parallel_tools, tool calls the model makes together run concurrently (see ParallelAgentExecutor)."""
+    llm = llm or get_chat_model(model=model, api_key=api_key)
     prompt = ChatPromptTemplate.from_messages([
         MessagesPlaceholder(variable_name = "chat_history"),
         ("human", "{input}"),
@@ -54,6 +182,15 @@ def create_react_tool_agent(
         tools = tools,
         prompt = prompt,
     )
+    if parallel_tools:
+        return ParallelAgentExecutor(
+            agent = agent,
+            tools = tools,
+            return_intermediate_steps = return_intermediate_steps,
+            max_concurrency = max_concurrency,
+            tool_timeout = tool_timeout,
+            tool_timeouts = tool_timeouts or {},
+        )
     executor = AgentExecutor(
         agent = agent,
         tools = tools,
@@ -0,0 +1,251 @@
+## Index backends for InMemoryOpenAIMemory.find_memories
+# FlatIndex is exact (one NumPy matrix product per query), HNSWIndex is approximate but sublinear.
+# Both map string ids to vectors and support add (which also updates), delete and top-k search by cosine similarity.
+# mem0_tools.MatrixVectorStore keeps the document text and uses one of these for the vectors.
+import time
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class FlatIndex:
+    """Exact cosine search over one contiguous, pre-normalised float32 matrix.
+
+    Ids map to rows; deleting an id tombstones its row (masked out of searches) and the row is reused by a later add.
+    A query is one matrix-vector product plus argpartition, and search_batch does many queries in one product.
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.matrix = None
+        self.live = np.zeros(0, dtype=bool) # False for tombstoned (or never used) rows
+        self.row_ids = [] # row -> id, None for tombstones
+        self.rows = {} # id -> row
+        self.free_rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, memory_id):
+        return memory_id in self.rows
+
+    def _reserve(self, dim, extra):
+        """Make sure there's a writable matrix with room for extra more rows."""
+        used = len(self.row_ids)
+        if self.matrix is None:
+            self.matrix = np.zeros((max(self.capacity, extra), dim), dtype=np.float32)
+            self.live = np.zeros(len(self.matrix), dtype=bool)
+        elif used + extra > len(self.matrix) or not self.matrix.flags.writeable:
+            # grow geometrically; this is also where a read-only memory-mapped matrix gets copied on first write
+            size = len(self.matrix)
+            if used + extra > size:
+                size = max(2 * size, used + extra)
+            matrix = np.zeros((size, self.matrix.shape[1]), dtype=np.float32)
+            matrix[:used] = self.matrix[:used]
+            live = np.zeros(size, dtype=bool)
+            live[:used] = self.live[:used]
+            self.matrix, self.live = matrix, live
+
+    def add(self, ids, vectors):
+        vectors = _normalize(np.atleast_2d(vectors))
+        if len(vectors) == 0:
+            return
+        new_ids = len(set(memory_id for memory_id in ids if memory_id not in self.rows))
+        self._reserve(vectors.shape[1], max(0, new_ids - len(self.free_rows)))
+        for memory_id, vector in zip(ids, vectors):
+            row = self.rows.get(memory_id)
+            if row is None:
+                if self.free_rows:
+                    row = self.free_rows.pop()
+                    self.row_ids[row] = memory_id
+                else:
+                    row = len(self.row_ids)
+                    self.row_ids.append(memory_id)
+                self.rows[memory_id] = row
+            self.matrix[row] = vector
+            self.live[row] = True
+
+    def load_matrix(self, ids, matrix):
+        """Use an already-normalised matrix (e.g. a read-only memory map) as-is when the index is empty."""
+        if self.rows or matrix.shape[0] != len(ids):
+            return self.add(ids, matrix)
+        self.matrix = matrix
+        self.live = np.ones(len(ids), dtype=bool)
+        self.row_ids = list(ids)
+        self.rows = {memory_id: row for row, memory_id in enumerate(ids)}
+        self.free_rows = []
+
+    def delete(self, ids):
+        for memory_id in ids:
+            row = self.rows.pop(memory_id, None)
+            if row is not None:
+                self.row_ids[row] = None
+                self.live[row] = False
+                self.free_rows.append(row)
+
+    def clear(self):
+        self.matrix = None
+        self.live = np.zeros(0, dtype=bool)
+        self.row_ids = []
+        self.rows = {}
+        self.free_rows = []
+
+    def get_vectors(self, ids):
+        """The stored (normalised) vectors for these ids, as one matrix."""
+        return self.matrix[[self.rows[memory_id] for memory_id in ids]]
+
+    def search(self, vector, k=5):
+        """Return up to k (id, score) pairs, best first."""
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors, k=5):
+        """Search for several query vectors with one matrix product. Returns one result list per query."""
+        queries = _normalize(np.atleast_2d(vectors))
+        if not self.rows:
+            return [[] for _ in queries]
+        used = len(self.row_ids)
+        scores = queries @ self.matrix[:used].T
+        if len(self.rows) < used:
+            scores[:, ~self.live[:used]] = -np.inf
+        k = min(k, len(self.rows))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for query_scores, query_top in zip(scores, top):
+            query_top = query_top[np.argsort(-query_scores[query_top])]
+            results.append([(self.row_ids[row], float(query_scores[row])) for row in query_top])
+        return results
+
+
+class HNSWIndex:
+    """Approximate cosine search with hnswlib (pip install hnswlib). The graph is created on the first add."""
+    def __init__(self, max_elements=10_000, ef_construction=200, M=16, ef=64):
+        if hnswlib is None:
+            raise ImportError("HNSWIndex needs hnswlib: pip install hnswlib")
+        self.max_elements = max_elements
+        self.ef_construction = ef_construction
+        self.M = M
+        self.ef = ef
+        self.index = None
+        self.labels = {} # id -> integer label used by hnswlib
+        self.ids = {} # label -> id
+        self.next_label = 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, memory_id):
+        return memory_id in self.labels
+
+    def add(self, ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        if self.index is None:
+            self.index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+            self.index.init_index(max_elements=self.max_elements, ef_construction=self.ef_construction, M=self.M)
+            self.index.set_ef(self.ef)
+        labels = []
+        for memory_id in ids:
+            if memory_id not in self.labels:
+                self.labels[memory_id] = self.next_label
+                self.ids[self.next_label] = memory_id
+                self.next_label += 1
+            labels.append(self.labels[memory_id])
+        needed = self.next_label
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        # re-adding an existing label replaces its vector, which is how updates work
+        self.index.add_items(vectors, labels)
+
+    def load_matrix(self, ids, matrix):
+        self.add(ids, matrix)
+
+    def delete(self, ids):
+        for memory_id in ids:
+            label = self.labels.pop(memory_id, None)
+            if label is not None:
+                del self.ids[label]
+                self.index.mark_deleted(label)
+
+    def clear(self):
+        self.index = None
+        self.labels.clear()
+        self.ids.clear()
+        self.next_label = 0
+
+    def get_vectors(self, ids):
+        return np.asarray(self.index.get_items([self.labels[memory_id] for memory_id in ids]), dtype=np.float32)
+
+    def search(self, vector, k=5):
+        """Return up to k (id, score) pairs, best first."""
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors, k=5):
+        """Search for several query vectors at once. Returns one result list per query."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if not self.labels:
+            return [[] for _ in vectors]
+        k = min(k, len(self.labels))
+        self.index.set_ef(max(self.ef, k))
+        labels, distances = self.index.knn_query(vectors, k=k)
+        return [
+            [(self.ids[label], 1.0 - float(distance)) for label, distance in zip(query_labels, query_distances)]
+            for query_labels, query_distances in zip(labels, distances)
+        ]
+
+
+def make_index(kind):
+    """Build an index backend by name: "flat" or "hnsw"."""
+    if kind == "flat":
+        return FlatIndex()
+    if kind == "hnsw":
+        return HNSWIndex()
+    raise ValueError(f"Unknown index type: {kind}")
+
+
+def benchmark_indexes(n=10_000, dim=512, n_queries=200, k=5, seed=0):
+    """Compare recall@k and per-query latency of each backend against LangChain's brute-force InMemoryVectorStore."""
+    from langchain_core.vectorstores import InMemoryVectorStore
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    rng = np.random.default_rng(seed)
+    # clustered data looks more like real embeddings than uniform noise does
+    centers = rng.normal(size=(n // 50, dim))
+    vectors = centers[rng.integers(len(centers), size=n)] + rng.normal(size=(n, dim))
+    queries = centers[rng.integers(len(centers), size=n_queries)] + rng.normal(size=(n_queries, dim))
+    ids = [str(i) for i in range(n)]
+
+    baseline = InMemoryVectorStore(embedding=DeterministicFakeEmbedding(size=dim))
+    for memory_id, vector in zip(ids, vectors.tolist()):
+        baseline.store[memory_id] = {"id": memory_id, "vector": vector, "text": memory_id, "metadata": {}}
+    start = time.perf_counter()
+    truth = [{doc.id for doc in baseline.similarity_search_by_vector(query, k=k)} for query in queries.tolist()]
+    results = {"brute force (InMemoryVectorStore)": (1.0, (time.perf_counter() - start) / n_queries * 1000)}
+
+    kinds = ["flat"] + (["hnsw"] if hnswlib is not None else [])
+    for kind in kinds:
+        index = make_index(kind)
+        index.add(ids, vectors)
+        start = time.perf_counter()
+        found = [{memory_id for memory_id, _ in index.search(query, k)} for query in queries]
+        elapsed = (time.perf_counter() - start) / n_queries * 1000
+        recall = sum(len(f & t) for f, t in zip(found, truth)) / (k * n_queries)
+        results[kind] = (recall, elapsed)
+
+    print(f"n={n} dim={dim} k={k}")
+    for name, (recall, ms) in results.items():
+        print(f"{name:36} recall@{k}={recall:.3f}  {ms:.3f} ms/query")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_indexes()
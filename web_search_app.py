@@ -8,7 +8,13 @@ import json
 import time
 import chainlit as cl
 from langchain_core.tools import tool 
-from tools import create_react_tool_agent
+from tools import create_react_tool_agent, get_embeddings
+from context_tools import ContextBuilder
+from cache_tools import ResponseCache, ToolResultCache
+from search_tools import cached_search_tool, cached_extract_tool, PageStore, fake_tavily_tools
+from mem0_tools import CachedEmbeddings
+from attachment_tools import AttachmentStore, ingest_files
+from chainlit_tools import SessionStore, stream_agent_response
 from langchain_tavily import TavilySearch, TavilyExtract
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 import app_memory_hook
@@ -18,10 +24,17 @@ with open("config.json", "r") as f:
 
 model = config["openai"]["default_model"]
 api_key = config["openai"]["api_key"]
-tavily_key = config["tavily"]["api_key"]
-os.environ["TAVILY_API_KEY"] = tavily_key
+tavily_key = config["tavily"].get("api_key")
+if tavily_key:
+    os.environ["TAVILY_API_KEY"] = tavily_key
+max_context_tokens = config.get("context", {}).get("max_tokens", 100_000)
 
-chat_history = []
+sessions = SessionStore(**config.get("sessions", {})) # history per chat, instead of one global list
+embedding_model = "text-embedding-3-small"
+embeddings = CachedEmbeddings(get_embeddings(model=embedding_model, api_key=api_key), model=embedding_model)
+# files are stored once by content hash and shared by all sessions
+attachments = AttachmentStore(embeddings, model=model, store_dir=config.get("attachments", {}).get("store_dir", "attachment_store"))
+context_builder = ContextBuilder(max_tokens=max_context_tokens, model=model, attachment_store=attachments)
 
 # custom tool
 @tool
@@ -35,37 +48,62 @@ def long_division(dividend: int, divisor: int) -> str:
     return f"The result of {dividend} divided by {divisor} is {quotient} with a remainder of {remainder} ({result})."
 
 # Initialize Tavily tools
-tavily_search_tool = TavilySearch(
-    max_results=5,
-    topic="general",
-    include_images=False,
-    include_raw_content=False
+# Results are cached and shared between sessions; set "fake": true under "tavily" in config.json to work offline
+tavily_config = config["tavily"]
+if tavily_config.get("fake"):
+    tavily_search, tavily_extract = fake_tavily_tools(max_results=5)
+else:
+    tavily_search = TavilySearch(
+        max_results=5,
+        topic="general",
+        include_images=False,
+        include_raw_content=False
+    )
+    tavily_extract = TavilyExtract(
+        extract_depth="basic",
+        include_images=False
+    )
+tavily_search_tool = cached_search_tool(
+    tavily_search, ToolResultCache(ttl_seconds=tavily_config.get("search_ttl_seconds", 900)),
 )
-
-tavily_extract_tool = TavilyExtract(
-    extract_depth="basic",
-    include_images=False
+tavily_extract_tool = cached_extract_tool(
+    tavily_extract, ToolResultCache(ttl_seconds=tavily_config.get("extract_ttl_seconds", 3600)),
+    pages=PageStore(tavily_config.get("page_store", "tavily_pages.sqlite")),
 )
 tools = [tavily_search_tool, tavily_extract_tool, long_division]
 
+# Repeated and near-identical questions are answered from the cache, but never ones that needed a live search
+response_cache = ResponseCache(
+    model,
+    embeddings=embeddings,
+    bypass_tools=[tavily_search_tool, tavily_extract_tool],
+    **config.get("response_cache", {}),
+)
+
 agent = create_react_tool_agent(
     model=model,
     api_key=api_key,
     tools=tools,
+    parallel_tools=True, # several searches/extracts in one turn cost the slowest one, not the sum
+    max_concurrency=config.get("tools", {}).get("max_concurrency", 4),
+    tool_timeout=config.get("tools", {}).get("timeout", 30),
 )
 
 # So I can see these variables from a notebook running this app as a thread
-app_memory_hook.chat_history = chat_history
+app_memory_hook.sessions = sessions
 app_memory_hook.agent = agent
+app_memory_hook.response_cache = response_cache
 
 
-@cl.on_chat_start
-async def on_chat_start(): 
-    chat_history.clear()  # Clear chat history at the start of each chat  
-    system_message = SystemMessage(
+def system_message():
+    # built per message instead of kept in the session's history, so a session that comes back empty still has it
+    return SystemMessage(
         content=f"You are a helpful assistant with access to several tools.  Today's date is {time.strftime('%Y-%m-%d')}. "
     )
-    chat_history.append(system_message)
+
+@cl.on_chat_start
+async def on_chat_start(): 
+    chat_history = sessions.reset().history  # Fresh history at the start of each chat
     intro_message = AIMessage(f"Welcome to the Chainlit app! I can perform long division and read file attachments. I also just learned to search the web! Try sending me a message or attaching a file.")
     chat_history.append(intro_message)
     await cl.Message(content=intro_message.content).send()
@@ -76,20 +114,20 @@ async def on_message(message: cl.Message):
     #global chat_history
     print(f"=== MESSAGE RECEIVED: {message.content} ===")
     input = message.content
-    if message.elements:
+    chat_history = sessions.current().history
+    # Attachments are stored once by content hash (read off the event loop, chunked and indexed);
+    # the history just gets a small reference to each, which the context builder expands into the relevant chunks
+    file_references = await ingest_files(message, attachments)
+    if file_references:
         print("=== FILE ATTACHMENTS RECEIVED ===")
-        for element in message.elements:
-            if element.type == "file" and (element.mime == "text/plain" or not element.mime): 
-                file_name = element.name if element.name else "(unknown file name)"
-                with open(element.path, "r") as f:
-                    file_text = f.read()
-                file_input = f"File name: {file_name}\nFile content:\n{file_text}"
-                chat_history.append(HumanMessage(content=file_input))
+        chat_history.extend(file_references)
     
-    response = await agent.ainvoke({
+    # the system message stays pinned while older turns drop out of the budget
+    # Tokens and tool calls show up in the UI as they happen
+    response = await stream_agent_response(agent, {
         "input": input,
-        "chat_history": chat_history,
-    })
+        "chat_history": await context_builder.abuild(input, history=chat_history, system_prompt=system_message()),
+    }, cache=response_cache)
     output = response["output"]
     if response["intermediate_steps"]:
         print("=== INTERMEDIATE STEPS ===")
@@ -99,11 +137,9 @@ async def on_message(message: cl.Message):
     chat_history.append(HumanMessage(content=input))
     chat_history.append(AIMessage(content=output))
 
-    print(f"=== SENDING RESPONSE: {output} ===")
-    # Let's do some fake "thinking" steps to test the UI
-    async with cl.Step(name="Test") as step:
-        # Step is sent as soon as the context manager is entered
-        step.input = "hello"
-        step.output = "world"
-    # Send the response back to the user
-    await cl.Message(content=output).send()
\ No newline at end of file
+    print(f"=== SENT RESPONSE: {output} ===")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    sessions.drop() # every chat starts over with a fresh state, so don't keep this one (or its spill file) around